@@ -0,0 +1,98 @@
+"""Compare the SQLite and Parquet stores for the indicator data on synthetic
+GHO payloads (see synthetic.py) shaped like the full GHO: about 194
+countries and thousands of indicators, each with a few dozen rows per
+country.
+
+Usage:
+    python benchmarks/data_store.py --countries 194 --indicators 500 --years 10
+
+The Parquet store needs the parquet extra (pyarrow).
+"""
+
+import argparse
+import logging
+from os import walk
+from os.path import getsize, join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from hdx.database import Database
+from pipeline import setup_offline
+from synthetic import SyntheticGHO
+
+from hdx.scraper.who.pipeline import Pipeline
+
+
+def folder_size(folder):
+    return sum(
+        getsize(join(root, name)) for root, _, names in walk(folder) for name in names
+    )
+
+
+def stage_seconds(pipeline, stage):
+    """Time the pipeline recorded for one of its stages"""
+    durations = pipeline.get_metrics().get_report()["durations"]["stage"]
+    return next(
+        duration["seconds"]
+        for duration in durations
+        if duration["labels"]["stage"] == stage
+    )
+
+
+def run(data_store, folder, synthetic, configuration):
+    timings = dict()
+    with Database(
+        dialect="sqlite", database=join(folder, "who_gho.sqlite")
+    ) as database:
+        session = database.get_session()
+        pipeline = Pipeline(
+            configuration, synthetic, folder, session, data_store=data_store
+        )
+
+        pipeline.populate_db(populate_db=True, create_archived_datasets=False)
+        timings["load"] = stage_seconds(pipeline, "populate_indicator_data")
+        timings["coverage"] = stage_seconds(pipeline, "coverage")
+
+        start = perf_counter()
+        pipeline.export_country_files(create_archived_datasets=False)
+        timings["export all"] = perf_counter() - start
+
+        start = perf_counter()
+        for country in synthetic.countries[:10]:
+            pipeline._export(pipeline._indicator_categories, set(), country)
+        timings["export 10 countries"] = perf_counter() - start
+
+        if data_store == "parquet":
+            timings["size MB"] = folder_size(join(folder, "indicator_data")) / 1e6
+        else:
+            timings["size MB"] = getsize(join(folder, "who_gho.sqlite")) / 1e6
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, default=194)
+    parser.add_argument("--indicators", type=int, default=500)
+    parser.add_argument("--years", type=int, default=10)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    synthetic = SyntheticGHO(args.countries, args.indicators, args.years)
+    configuration = setup_offline(synthetic)
+    print(
+        f"{len(synthetic.countries)} countries, {len(synthetic.indicators)} "
+        f"indicators, {synthetic.rows} rows"
+    )
+    results = dict()
+    for data_store in ("sqlite", "parquet"):
+        with TemporaryDirectory() as folder:
+            results[data_store] = run(data_store, folder, synthetic, configuration)
+    print(f"{'':22}{'sqlite':>10}{'parquet':>10}")
+    for name in results["sqlite"]:
+        print(
+            f"{name:22}{results['sqlite'][name]:10.2f}{results['parquet'][name]:10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""Local stand-in for the GHO and category APIs for offline load testing
+
+Serves api/dimension, api/DIMENSION/{code}/DimensionValues, api/indicator,
+api/{code} and GHO_MODEL/SF_HIERARCHY_INDICATORS either from synthetic data
+(see synthetic.py) or from the JSON files that a run with --save wrote to
+saved_data. Latency, rate limiting with 429 responses and the size of the
+indicator payloads can be configured.
+
+To point the scraper at it, copy the project configuration and set:
+
+    base_url: "http://127.0.0.1:8000/"
+    category_url: "http://127.0.0.1:8000/"
+
+raising rate_limit to test throughput above one request a second. The
+showcase pages are still checked on who.int.
+
+Usage:
+    python benchmarks/gho_server.py --countries 194 --indicators 2000 --years 20
+    python benchmarks/gho_server.py --fixtures saved_data --latency 0.2 --rate-limit 20
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import uniform
+from tempfile import mkdtemp
+from time import monotonic, sleep
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
+from synthetic import SyntheticGHO
+
+logger = logging.getLogger(__name__)
+
+# Added to the ids of the copies of rows when payloads are repeated
+_ID_STEP = 1_000_000_000
+
+
+def _is_indicator_data(path: str) -> bool:
+    return (
+        path.startswith("api/")
+        and path not in ("api/dimension", "api/indicator")
+        and not path.startswith("api/DIMENSION/")
+    )
+
+
+class RateLimit:
+    """Sliding window limit of calls per period, shared by all clients
+
+    Args:
+        calls (int): Calls allowed in each period
+        period (float): Period in seconds
+    """
+
+    def __init__(self, calls: int, period: float):
+        self._calls = calls
+        self._period = period
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def allow(self) -> Optional[float]:
+        """Record a call if it is allowed
+
+        Returns:
+            Optional[float]: None if the call is allowed, else seconds until it would be
+        """
+        now = monotonic()
+        with self._lock:
+            while self._times and now - self._times[0] >= self._period:
+                self._times.popleft()
+            if len(self._times) >= self._calls:
+                return self._period - (now - self._times[0])
+            self._times.append(now)
+            return None
+
+
+class GHOStandIn(ThreadingHTTPServer):
+    """Threaded HTTP server answering GHO API and category requests with
+    payloads from a source that has a download_json(url) method, like
+    SyntheticGHO or a Retrieve reading saved data. Indicator payloads can be
+    made larger by repeating their rows with new ids. Responses have an ETag
+    and conditional requests with a matching If-None-Match get a 304, like
+    the real API, so incremental refreshes can be tested too. Requests for
+    which the source has no data get a 404.
+
+    Args:
+        source: Object with a download_json(url) method returning the payload of a URL
+        address (str): Address to listen on. Defaults to 127.0.0.1.
+        port (int): Port to listen on. Defaults to 0 (any free port).
+        latency (float): Seconds to wait before each response. Defaults to 0.
+        jitter (float): Random extra wait of up to this many seconds. Defaults to 0.
+        rate_limit (Optional[RateLimit]): Answer requests over the limit with a 429. Defaults to None.
+        repeat (int): Number of copies of the rows of each indicator payload. Defaults to 1.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        source,
+        address: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0,
+        jitter: float = 0,
+        rate_limit: Optional[RateLimit] = None,
+        repeat: int = 1,
+    ):
+        super().__init__((address, port), _Handler)
+        self.source = source
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.repeat = repeat
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        """URL to use as base_url and category_url"""
+        address, port = self.server_address[:2]
+        return f"http://{address}:{port}/"
+
+    def count(self, throttled: bool) -> None:
+        with self._lock:
+            self.requests += 1
+            if throttled:
+                self.throttled += 1
+
+    def get_payload(self, path: str) -> Optional[Dict]:
+        try:
+            payload = self.source.download_json(f"{self.url}{path}")
+        except Exception:
+            return None
+        if self.repeat > 1 and _is_indicator_data(path):
+            rows = payload["value"]
+            payload = {
+                **payload,
+                "value": [
+                    {**row, "Id": row["Id"] + copy * _ID_STEP}
+                    for copy in range(self.repeat)
+                    for row in rows
+                ],
+            }
+        return payload
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: GHOStandIn
+
+    def do_GET(self):
+        server = self.server
+        retry_after = server.rate_limit.allow() if server.rate_limit else None
+        server.count(retry_after is not None)
+        if retry_after is not None:
+            self.send_response(429)
+            self.send_header("Retry-After", str(max(1, round(retry_after))))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        wait = server.latency + (uniform(0, server.jitter) if server.jitter else 0)
+        if wait:
+            sleep(wait)
+        payload = server.get_payload(urlsplit(self.path).path.strip("/"))
+        if payload is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(payload).encode("utf-8")
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def saved_data_source(folder: str) -> Retrieve:
+    """Source reading the JSON files that a run with --save wrote to folder
+
+    Args:
+        folder (str): Folder of saved data
+
+    Returns:
+        Retrieve: Retriever that only reads saved files
+    """
+    temp_folder = mkdtemp(prefix="gho_server_")
+    return Retrieve(
+        Download(user_agent="gho_server"),
+        temp_folder,
+        folder,
+        temp_folder,
+        save=False,
+        use_saved=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--fixtures", help="Serve the data saved in this folder by a run with --save"
+    )
+    parser.add_argument("--countries", type=int, default=194)
+    parser.add_argument("--indicators", type=int, default=500)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument(
+        "--rate-limit", type=int, help="Requests allowed in each period"
+    )
+    parser.add_argument("--period", type=float, default=1)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Copies of each indicator's rows"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.fixtures:
+        source = saved_data_source(args.fixtures)
+    else:
+        source = SyntheticGHO(args.countries, args.indicators, args.years)
+    server = GHOStandIn(
+        source,
+        args.address,
+        args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=RateLimit(args.rate_limit, args.period) if args.rate_limit else None,
+        repeat=args.repeat,
+    )
+    logger.info(f"Serving GHO API stand-in at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(
+            f"Answered {server.requests} requests, {server.throttled} with a 429"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Benchmark the pipeline stages offline on synthetic GHO payloads
+
+Runs populate_db (which includes the coverage of each country's
+categories), the creation of each country's tags, the export and the
+generation of the datasets and archived datasets of every country against
+SyntheticGHO, and reports the wall time, throughput and peak resident
+memory of each stage as JSON.
+
+Usage:
+    python benchmarks/pipeline.py --countries 194 --indicators 2000 --years 20
+
+To measure what the load-time PRAGMAs of _bulk_load save, compare the
+populate_db stage of a run with --no-bulk-load to one without it.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+from contextlib import nullcontext
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from hdx.api.configuration import Configuration
+from hdx.api.locations import Locations
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.database import Database
+from hdx.location.country import Country
+from hdx.utilities.path import script_dir_plus_file
+from synthetic import SyntheticGHO
+
+from hdx.scraper.who.export import current_rss
+from hdx.scraper.who.pipeline import Pipeline
+
+
+class PeakMemory:
+    """Samples the resident memory of the process in a background thread to
+    find its peak while a stage runs. Needs /proc, so the peak is None on
+    other platforms."""
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+        self._stop = threading.Event()
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self._interval):
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        rss = current_rss()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+
+def run_stage(
+    stages: List[Dict], name: str, unit: str, count: int, function: Callable
+) -> None:
+    with PeakMemory() as memory:
+        start = perf_counter()
+        function()
+        seconds = perf_counter() - start
+    stages.append(
+        {
+            "stage": name,
+            "seconds": round(seconds, 3),
+            "unit": unit,
+            "count": count,
+            "per_second": round(count / seconds, 1) if seconds else None,
+            "peak_rss_mb": round(memory.peak / 1048576, 1) if memory.peak else None,
+        }
+    )
+    print(f"{name}: {seconds:.2f}s", file=sys.stderr)
+
+
+def setup_offline(synthetic: SyntheticGHO) -> Configuration:
+    """Create the HDX configuration and stub the lookups that would otherwise
+    be downloaded from HDX. The synthetic categories are approved tags."""
+    Configuration._create(
+        hdx_read_only=True,
+        hdx_site="prod",
+        user_agent="benchmark",
+        project_config_yaml=script_dir_plus_file(
+            join("config", "project_configuration.yaml"), Pipeline
+        ),
+    )
+    Country.countriesdata(use_live=False)
+    Locations.set_validlocations(
+        [
+            {"name": code.lower(), "title": Country.get_country_name_from_iso3(code)}
+            for code in synthetic.countries
+        ]
+    )
+    Vocabulary._approved_vocabulary = {
+        "tags": [{"name": "hxl"}, {"name": "indicators"}]
+        + [{"name": category.lower()} for category in synthetic.categories],
+        "id": "b891512e-9516-4bf5-962a-7a289772a2a1",
+        "name": "approved",
+    }
+    Vocabulary._tags_dict = {"_": {"Action to Take": "ok"}}
+    Resource._formats_dict = {"csv": "csv"}
+    return Configuration.read()
+
+
+def run(
+    synthetic: SyntheticGHO,
+    folder: str,
+    data_store: str = "sqlite",
+    async_ingest: bool = False,
+    bulk_load: bool = True,
+) -> List[Dict]:
+    """Run the stages in folder and return their measurements"""
+    configuration = setup_offline(synthetic)
+    stages = []
+    with Database(
+        dialect="sqlite", database=join(folder, "who_gho.sqlite")
+    ) as database:
+        session = database.get_session()
+        pipeline = Pipeline(
+            configuration, synthetic, folder, session, data_store=data_store
+        )
+        if not bulk_load:
+            pipeline._bulk_load = nullcontext
+        run_stage(
+            stages,
+            "populate_db",
+            "rows",
+            synthetic.rows,
+            lambda: pipeline.populate_db(
+                populate_db=True,
+                create_archived_datasets=True,
+                async_ingest=async_ingest,
+            ),
+        )
+        countries = pipeline.get_countries()
+
+        run_stage(
+            stages,
+            "create_tags",
+            "countries",
+            len(countries),
+            lambda: [
+                pipeline._create_tags(country["Code"], False) for country in countries
+            ],
+        )
+        run_stage(
+            stages,
+            "export_country_files",
+            "rows",
+            synthetic.rows,
+            lambda: pipeline.export_country_files(create_archived_datasets=True),
+        )
+        run_stage(
+            stages,
+            "generate_dataset_and_showcase",
+            "countries",
+            len(countries),
+            lambda: [
+                pipeline.generate_dataset_and_showcase(country) for country in countries
+            ],
+        )
+        run_stage(
+            stages,
+            "generate_archived_dataset",
+            "countries",
+            len(countries),
+            lambda: [
+                pipeline.generate_archived_dataset(country) for country in countries
+            ],
+        )
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--countries", type=int, default=194)
+    parser.add_argument("--indicators", type=int, default=500)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--data-store", choices=("sqlite", "parquet"), default="sqlite")
+    parser.add_argument("--async-ingest", action="store_true")
+    parser.add_argument(
+        "--no-bulk-load",
+        action="store_true",
+        help="Load without the load-time PRAGMAs of _bulk_load",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    synthetic = SyntheticGHO(
+        args.countries, args.indicators, args.years, categories=args.categories
+    )
+    with TemporaryDirectory() as folder:
+        stages = run(
+            synthetic,
+            folder,
+            args.data_store,
+            args.async_ingest,
+            not args.no_bulk_load,
+        )
+    results = {
+        "parameters": {
+            "countries": len(synthetic.countries),
+            "indicators": len(synthetic.indicators),
+            "years": len(synthetic.years),
+            "categories": len(synthetic.categories),
+            "rows": synthetic.rows,
+            "data_store": args.data_store,
+            "async_ingest": args.async_ingest,
+            "bulk_load": not args.no_bulk_load,
+        },
+        "stages": stages,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
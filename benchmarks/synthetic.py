@@ -0,0 +1,181 @@
+"""Synthetic GHO API payloads for benchmarking the pipeline offline"""
+
+from random import Random
+from typing import Dict, List
+from urllib.parse import urlparse
+
+from hdx.location.country import Country
+from hdx.utilities.base_downloader import DownloadError
+
+_SEXES = (
+    ("SEX_BTSX", "Both sexes"),
+    ("SEX_FMLE", "Female"),
+    ("SEX_MLE", "Male"),
+)
+_REGIONS = (
+    ("AFR", "Africa"),
+    ("AMR", "Americas"),
+    ("EMR", "Eastern Mediterranean"),
+    ("EUR", "Europe"),
+    ("SEAR", "South-East Asia"),
+    ("WPR", "Western Pacific"),
+)
+
+
+def country_codes(countries: int) -> List[str]:
+    """The first ISO3 codes known to hdx-python-country, since the pipeline
+    looks up country names from their codes
+
+    Args:
+        countries (int): Number of countries
+
+    Returns:
+        List[str]: ISO3 codes
+    """
+    return sorted(Country.countriesdata(use_live=False)["countries"].keys())[:countries]
+
+
+class SyntheticGHO:
+    """Stands in for the retriever of the pipeline, answering download_json
+    for the GHO API and category URLs with generated payloads of the shape
+    the real APIs return. Every indicator has one row per country, year and
+    sex. One in archived_every indicators has no category so that it is
+    archived, the others are in one or two of the categories. Unknown
+    indicators raise a DownloadError like a 404 from the API does. Payloads
+    are generated deterministically from the seed when requested, so memory
+    use does not grow with the number of indicators.
+
+    Args:
+        countries (int): Number of countries
+        indicators (int): Number of indicators
+        years (int): Number of years of data of each indicator
+        categories (int): Number of categories. Defaults to 12.
+        archived_every (int): Every archived_every-th indicator is archived. Defaults to 10.
+        seed (int): Random seed. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        countries: int,
+        indicators: int,
+        years: int,
+        categories: int = 12,
+        archived_every: int = 10,
+        seed: int = 0,
+    ):
+        self.countries = country_codes(countries)
+        self.indicators = [f"SYN_{i:05d}" for i in range(indicators)]
+        self._indicator_indexes = {code: i for i, code in enumerate(self.indicators)}
+        self.years = list(range(2024 - years, 2024))
+        self.categories = [f"Synthetic category {i}" for i in range(categories)]
+        self._archived_every = archived_every
+        self._seed = seed
+        self._rows_per_indicator = len(self.countries) * len(self.years) * len(_SEXES)
+
+    @property
+    def rows(self) -> int:
+        """Number of indicator data rows of all indicators"""
+        return self._rows_per_indicator * len(self.indicators)
+
+    def is_archived(self, index: int) -> bool:
+        return index % self._archived_every == self._archived_every - 1
+
+    def download_file(self, url: str, **kwargs) -> None:
+        # Showcase pages always exist
+        return None
+
+    def download_json(self, url: str, **kwargs) -> Dict:
+        path = urlparse(url).path.strip("/")
+        if path.startswith("api/"):
+            path = path[4:]
+        if path == "dimension":
+            return self._dimensions()
+        if path.startswith("DIMENSION/"):
+            return self._dimension_values(path.split("/")[1])
+        if path == "indicator":
+            return self._indicator_list()
+        if path == "GHO_MODEL/SF_HIERARCHY_INDICATORS":
+            return self._categories()
+        return self._indicator_data(path)
+
+    @staticmethod
+    def _dimensions() -> Dict:
+        return {
+            "value": [
+                {"Code": "COUNTRY", "Title": "Country"},
+                {"Code": "SEX", "Title": "Sex"},
+            ]
+        }
+
+    def _dimension_values(self, dimension_code: str) -> Dict:
+        if dimension_code == "COUNTRY":
+            return {
+                "value": [
+                    {"Code": code, "Title": code, "Dimension": "COUNTRY"}
+                    for code in self.countries
+                ]
+            }
+        if dimension_code == "SEX":
+            return {"value": [{"Code": code, "Title": title} for code, title in _SEXES]}
+        return {"value": []}
+
+    def _indicator_list(self) -> Dict:
+        return {
+            "value": [
+                {"IndicatorCode": code, "IndicatorName": f"Synthetic indicator {code}"}
+                for code in self.indicators
+            ]
+        }
+
+    def _categories(self) -> Dict:
+        rows = []
+        for i, code in enumerate(self.indicators):
+            if self.is_archived(i):
+                continue
+            category_indexes = {i % len(self.categories)}
+            if i % 3 == 0:
+                category_indexes.add((i + 1) % len(self.categories))
+            for category_index in sorted(category_indexes):
+                rows.append(
+                    {
+                        "THEME_TITLE": self.categories[category_index],
+                        "INDICATOR_URL_NAME": code.lower(),
+                        "INDICATOR_CODE": code,
+                    }
+                )
+        return {"value": rows}
+
+    def _indicator_data(self, code: str) -> Dict:
+        index = self._indicator_indexes.get(code)
+        if index is None:
+            # Like the retriever when the API answers 404
+            raise DownloadError(f"No indicator {code}")
+        random = Random(f"{self._seed}-{code}")
+        first_id = index * self._rows_per_indicator
+        rows = []
+        for country_index, country in enumerate(self.countries):
+            region_code, region = _REGIONS[country_index % len(_REGIONS)]
+            for year in self.years:
+                for sex, _ in _SEXES:
+                    numeric = round(random.uniform(0, 1000), 5)
+                    rows.append(
+                        {
+                            "Id": first_id + len(rows),
+                            "IndicatorCode": code,
+                            "SpatialDimType": "COUNTRY",
+                            "SpatialDim": country,
+                            "ParentLocationCode": region_code,
+                            "TimeDimType": "YEAR",
+                            "ParentLocation": region,
+                            "Dim1Type": "SEX",
+                            "Dim1": sex,
+                            "TimeDim": year,
+                            "Value": f"{numeric:.1f}",
+                            "NumericValue": numeric,
+                            "Low": None,
+                            "High": None,
+                            "TimeDimensionBegin": f"{year}-01-01T00:00:00+01:00",
+                            "TimeDimensionEnd": f"{year}-12-31T00:00:00+01:00",
+                        }
+                    )
+        return {"value": rows}
@@ -6,32 +6,32 @@ script then creates in HDX.
 """
 
 import logging
+from contextlib import nullcontext
 from os.path import expanduser, join
 from pathlib import Path
 
 from hdx.api.configuration import Configuration
-from hdx.data.hdxobject import HDXError
 from hdx.data.showcase import Showcase
 from hdx.data.user import User
 from hdx.database import Database
 from hdx.facades.infer_arguments import facade
-from hdx.utilities.downloader import Download, DownloadError
+from hdx.utilities.downloader import Download
 from hdx.utilities.path import (
     progress_storing_folder,
     script_dir_plus_file,
     wheretostart_tempdir_batch,
 )
 from hdx.utilities.retriever import Retrieve
-from tenacity import (
-    after_log,
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_fixed,
-)
+from tenacity import wait_random_exponential
 
 from hdx.scraper.who._version import __version__
+from hdx.scraper.who.country_workers import CountryWorkers
+from hdx.scraper.who.metrics import RunMetrics
 from hdx.scraper.who.pipeline import Pipeline
+from hdx.scraper.who.retry_queue import DeferredRetries
+from hdx.scraper.who.upload_queue import UploadQueue
+from hdx.scraper.who.upload_state import UploadState
+from hdx.scraper.who.url_probe import UrlProbe
 
 logger = logging.getLogger(__name__)
 
@@ -45,12 +45,28 @@ def main(
     use_saved: bool = False,
     populate_db: bool = True,
     create_archived_datasets: bool = False,
+    download_workers: int = 1,
+    async_ingest: bool = False,
+    stream_json: bool = False,
+    incremental: bool = False,
+    country_workers: int = 1,
+    upload_workers: int = 0,
+    skip_unchanged: bool = False,
+    data_store: str = "sqlite",
 ) -> None:
     """Generate datasets and create them in HDX
 
     Args:
         save (bool): Save downloaded data. Defaults to False.
         use_saved (bool): Use saved data. Defaults to False.
+        download_workers (int): Number of threads downloading indicators. Defaults to 1.
+        async_ingest (bool): Overlap indicator downloads with database writes using asyncio. Defaults to False.
+        stream_json (bool): Parse indicator files incrementally instead of loading them whole. Defaults to False.
+        incremental (bool): Keep the database and only refresh changed indicators. Defaults to False.
+        country_workers (int): Number of threads generating and uploading country datasets. Defaults to 1.
+        upload_workers (int): Number of threads uploading datasets generated in the main thread. Defaults to 0 (upload each country after generating it).
+        skip_unchanged (bool): Do not upload datasets that are unchanged since they were last uploaded. Defaults to False.
+        data_store (str): Store for the indicator data, sqlite or parquet (needs the parquet extra). Defaults to sqlite.
 
     Returns:
         None
@@ -59,14 +75,29 @@ def main(
     configuration = Configuration.read()
     User.check_current_user_write_access("hdx")
 
-    with wheretostart_tempdir_batch(folder=_LOOKUP) as info:
+    metrics_config = configuration["metrics"]
+    Path(metrics_config["json"]).parent.mkdir(parents=True, exist_ok=True)
+    Path(metrics_config["textfile"]).parent.mkdir(parents=True, exist_ok=True)
+    with (
+        wheretostart_tempdir_batch(folder=_LOOKUP) as info,
+        RunMetrics().report(
+            metrics_config["json"], metrics_config["textfile"]
+        ) as metrics,
+    ):
         tempdir = info["folder"]
+        if incremental:
+            # The temporary folder is deleted after a successful run, so the
+            # database has to live elsewhere to be kept between runs
+            Path(_SAVED_DATA_DIR).mkdir(parents=True, exist_ok=True)
+            database_path = join(_SAVED_DATA_DIR, "who_gho.sqlite")
+        else:
+            database_path = f"/{tempdir}/who_gho.sqlite"
         params = {
             "dialect": "sqlite",
-            "database": f"/{tempdir}/who_gho.sqlite",
+            "database": database_path,
         }
-        # Remove sqlite file if re-populating
-        if populate_db:
+        # Remove sqlite file if re-populating from scratch
+        if populate_db and not incremental:
             logger.warning("Populating DB, removing sqlite file if it exists")
             Path(params["database"]).unlink(missing_ok=True)
             logger.warning(
@@ -76,7 +107,8 @@ def main(
             )
         with Database(**params) as database:
             session = database.get_session()
-            with Download(rate_limit={"calls": 1, "period": 1}) as downloader:
+            with Download(rate_limit=configuration["rate_limit"]) as downloader:
+                metrics.instrument_session(downloader.session)
                 retriever = Retrieve(
                     downloader,
                     tempdir,
@@ -86,50 +118,189 @@ def main(
                     use_saved,
                 )
 
-                pipeline = Pipeline(configuration, retriever, tempdir, session)
+                if save or use_saved:
+                    # Showcase pages are saved and read like other downloads
+                    url_probe = None
+                else:
+                    probe_config = configuration["showcase_probe"]
+                    Path(_SAVED_DATA_DIR).mkdir(parents=True, exist_ok=True)
+                    url_probe = UrlProbe(
+                        downloader.session,
+                        join(_SAVED_DATA_DIR, "showcase_urls.json"),
+                        ttl=probe_config["ttl_days"] * 24 * 3600,
+                        workers=probe_config["workers"],
+                        timeout=probe_config["timeout"],
+                    )
+
+                pipeline = Pipeline(
+                    configuration,
+                    retriever,
+                    tempdir,
+                    session,
+                    download_workers=download_workers,
+                    stream_json=stream_json,
+                    incremental=incremental,
+                    url_probe=url_probe,
+                    data_store=data_store,
+                    metrics=metrics,
+                )
 
                 pipeline.populate_db(
                     populate_db=populate_db,
                     create_archived_datasets=create_archived_datasets,
+                    async_ingest=async_ingest,
                 )
                 countries = pipeline.get_countries()
+                pipeline.export_country_files(create_archived_datasets)
+                pipeline.probe_showcase_urls(countries)
 
                 logger.info(f"Number of countries: {len(countries)}")
 
-                for _, country in progress_storing_folder(
-                    info,
-                    countries,
-                    "Code",
-                ):
-                    process_country(
+                if skip_unchanged:
+                    Path(_SAVED_DATA_DIR).mkdir(parents=True, exist_ok=True)
+                    upload_state = UploadState(
+                        join(_SAVED_DATA_DIR, "upload_hashes.json")
+                    )
+                else:
+                    upload_state = None
+
+                retry_config = configuration["retries"]
+                retries = DeferredRetries(
+                    attempts=retry_config["attempts"],
+                    wait=wait_random_exponential(
+                        multiplier=retry_config["multiplier"],
+                        max=retry_config["max_wait"],
+                    ),
+                    time_budget=retry_config["time_budget"],
+                )
+
+                def defer_country(error, country):
+                    retries.defer(
+                        country["Code"],
+                        error,
+                        process_country,
                         pipeline,
                         country,
                         info,
                         create_archived_datasets,
+                        upload_state,
                     )
 
+                if country_workers > 1:
+                    # Let go of the read transaction of the populating session
+                    session.commit()
 
-@retry(
-    retry=(retry_if_exception_type(DownloadError) | retry_if_exception_type(HDXError)),
-    stop=stop_after_attempt(5),
-    wait=wait_fixed(3600),
-    after=after_log(logger, logging.INFO),
-)
-def process_country(who, country, info, create_archived_datasets):
-    upload_dataset(who, country, info)
-    if create_archived_datasets:
-        upload_archived_dataset(who, country, info)
+                    def process(worker_pipeline, country):
+                        try:
+                            process_country(
+                                worker_pipeline,
+                                country,
+                                info,
+                                create_archived_datasets,
+                                upload_state,
+                            )
+                        except retries.exceptions as ex:
+                            # Retries run in the main thread with its pipeline
+                            defer_country(ex, country)
 
+                    CountryWorkers(
+                        pipeline,
+                        retriever,
+                        database_path,
+                        country_workers,
+                        configuration["rate_limit"],
+                    ).run(process, info, countries)
+                elif upload_workers > 0:
+
+                    def generate(country):
+                        try:
+                            return generate_country(
+                                pipeline, country, create_archived_datasets
+                            )
+                        except retries.exceptions as ex:
+                            defer_country(ex, country)
+                            return None
+
+                    UploadQueue(
+                        generate,
+                        lambda generated: retries.call(
+                            generated[0]["Code"],
+                            upload_country,
+                            generated,
+                            info,
+                            upload_state,
+                            metrics,
+                        ),
+                        upload_workers,
+                    ).run(info, countries)
+                else:
+                    for _, country in progress_storing_folder(
+                        info,
+                        countries,
+                        "Code",
+                    ):
+                        retries.call(
+                            country["Code"],
+                            process_country,
+                            pipeline,
+                            country,
+                            info,
+                            create_archived_datasets,
+                            upload_state,
+                        )
 
-def upload_dataset(who, country, info):
-    (dataset, showcase) = who.generate_dataset_and_showcase(country)
-    if not dataset:
+                retries.drain(join(tempdir, "retry_summary.json"), info, countries)
+                if upload_state:
+                    upload_state.log_summary()
+
+
+def process_country(who, country, info, create_archived_datasets, upload_state=None):
+    upload_country(
+        generate_country(who, country, create_archived_datasets),
+        info,
+        upload_state,
+        who.get_metrics(),
+    )
+
+
+def generate_country(who, country, create_archived_datasets):
+    with who.get_metrics().time("country_generate", country=country["Code"]):
+        (dataset, showcase) = who.generate_dataset_and_showcase(country)
+        if dataset:
+            who.update_from_static_metadata(dataset)
+        archived_dataset = None
+        if create_archived_datasets:
+            archived_dataset = who.generate_archived_dataset(country)
+            if archived_dataset:
+                who.update_from_static_metadata(archived_dataset)
+    if not dataset and not archived_dataset:
+        return None
+    return country, dataset, showcase, archived_dataset
+
+
+def upload_country(generated, info, upload_state=None, metrics=None):
+    if generated is None:
         return
+    country, dataset, showcase, archived_dataset = generated
+    with (
+        metrics.time("country_upload", country=country["Code"])
+        if metrics
+        else nullcontext()
+    ):
+        if dataset:
+            upload_dataset(country, dataset, showcase, info, upload_state)
+        if archived_dataset:
+            upload_archived_dataset(country, archived_dataset, info, upload_state)
+
+
+def upload_dataset(country, dataset, showcase, info, upload_state=None):
+    if upload_state:
+        content_hash = upload_state.get_hash(dataset, showcase)
+        if upload_state.is_unchanged(dataset["name"], content_hash):
+            logger.info(f"Dataset for {country['Code']} is unchanged, not uploading")
+            return
 
     logger.info(f"Uploading dataset for {country['Code']}")
-    dataset.update_from_yaml(
-        script_dir_plus_file(join("config", "hdx_dataset_static.yaml"), main)
-    )
     dataset.create_in_hdx(
         remove_additional_resources=True,
         match_resource_order=False,
@@ -147,18 +318,21 @@ def upload_dataset(who, country, info):
         if showcase:
             showcase.delete_from_hdx()
 
+    if upload_state:
+        upload_state.record(dataset["name"], content_hash)
     logger.info(f"Finished uploading dataset for {country['Code']}")
 
 
-def upload_archived_dataset(who, country, info):
-    archived_dataset = who.generate_archived_dataset(country)
-    if not archived_dataset:
-        return
+def upload_archived_dataset(country, archived_dataset, info, upload_state=None):
+    if upload_state:
+        content_hash = upload_state.get_hash(archived_dataset)
+        if upload_state.is_unchanged(archived_dataset["name"], content_hash):
+            logger.info(
+                f"Archived dataset for {country['Code']} is unchanged, not uploading"
+            )
+            return
 
     logger.info(f"Uploading archived dataset for {country['Code']}")
-    archived_dataset.update_from_yaml(
-        script_dir_plus_file(join("config", "hdx_dataset_static.yaml"), main)
-    )
     archived_dataset.create_in_hdx(
         remove_additional_resources=True,
         match_resource_order=False,
@@ -166,6 +340,8 @@ def upload_archived_dataset(who, country, info):
         updated_by_script="HDX Scraper: WHO",
         batch=info["batch"],
     )
+    if upload_state:
+        upload_state.record(archived_dataset["name"], content_hash)
     logger.info(f"Finished uploading archived dataset for {country['Code']}")
 
 
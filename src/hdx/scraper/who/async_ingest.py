@@ -0,0 +1,175 @@
+"""asyncio producer/consumer engine for ingesting indicator data"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StageStats:
+    """Rows (or other units) and bytes handled by a stage and the time the
+    stage was busy. For the fetch stage, whose fetchers run concurrently,
+    that is the time from the start of the first fetch to the end of the
+    last."""
+
+    def __init__(self, name: str, unit: str = "rows"):
+        self.name = name
+        self.unit = unit
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @contextmanager
+    def time(self):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += perf_counter() - start
+
+    @property
+    def rate(self) -> float:
+        if not self.seconds:
+            return 0.0
+        return self.rows / self.seconds
+
+    def __str__(self) -> str:
+        text = (
+            f"{self.name}: {self.rows} {self.unit} in {self.seconds:.1f}s "
+            f"({self.rate:.1f} {self.unit}/sec)"
+        )
+        if self.bytes:
+            megabytes = self.bytes / 1048576
+            rate = megabytes / self.seconds if self.seconds else 0.0
+            text = f"{text}, {megabytes:.1f} MB ({rate:.1f} MB/sec)"
+        return text
+
+
+class AsyncIngest:
+    """Fetches payloads with several concurrent fetchers and hands them to a
+    single consumer through a bounded queue. When the queue is full, the
+    fetchers wait, so at most queue_size + fetchers payloads are in memory at
+    any time. Fetching happens in worker threads so that network time
+    overlaps with the parsing and inserting done by the consumer. Payloads are
+    consumed in the order they arrive. The fetch statistics count the rows
+    of payloads that are dictionaries and the bytes of payloads with a size,
+    like files that are only parsed when written.
+
+    Args:
+        fetch (Callable[[Any], Any]): Blocking function returning the payload for an item or None
+        write (Callable[[Any, Any, StageStats], int]): Blocking function that parses and writes a payload, timing its inserts with the given StageStats and returning the number of rows written
+        fetchers (int): Number of concurrent fetchers. Defaults to 1.
+        queue_size (Optional[int]): Maximum number of fetched payloads waiting to be written. Defaults to the number of fetchers.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[Any], Any],
+        write: Callable[[Any, Any, StageStats], int],
+        fetchers: int = 1,
+        queue_size: Optional[int] = None,
+    ):
+        self._fetch = fetch
+        self._write = write
+        self._fetchers = max(fetchers, 1)
+        self._queue_size = queue_size or self._fetchers
+        self._fetch_start = None
+        self.stats = {
+            "fetch": StageStats("fetch"),
+            "parse": StageStats("parse"),
+            "insert": StageStats("insert"),
+        }
+
+    def run(self, items: Iterable[Any]) -> Dict[str, StageStats]:
+        """Ingest all items, blocking until done
+
+        Args:
+            items (Iterable[Any]): Items to fetch and write
+
+        Returns:
+            Dict[str, StageStats]: Statistics for the fetch, parse and insert stages
+        """
+        start = perf_counter()
+        asyncio.run(self._run(items))
+        elapsed = perf_counter() - start
+        for stage in self.stats.values():
+            logger.info(str(stage))
+        rows = self.stats["insert"].rows
+        logger.info(
+            f"Ingested {rows} rows in {elapsed:.1f}s "
+            f"({rows / elapsed if elapsed else 0:.0f} rows/sec)"
+        )
+        return self.stats
+
+    async def _run(self, items: Iterable[Any]) -> None:
+        self._fetch_start = None
+        work = asyncio.Queue()
+        for item in items:
+            work.put_nowait(item)
+        payloads = asyncio.Queue(maxsize=self._queue_size)
+        executor = ThreadPoolExecutor(
+            max_workers=self._fetchers, thread_name_prefix="fetch"
+        )
+        fetchers = asyncio.gather(
+            *(self._produce(work, payloads, executor) for _ in range(self._fetchers))
+        )
+        consumer = asyncio.ensure_future(self._consume(payloads))
+        try:
+            # The consumer only finishes early if it failed
+            await asyncio.wait(
+                (fetchers, consumer), return_when=asyncio.FIRST_COMPLETED
+            )
+            if consumer.done():
+                consumer.result()
+            await fetchers
+            await payloads.put(_DONE)
+            await consumer
+        finally:
+            fetchers.cancel()
+            consumer.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _produce(
+        self,
+        work: asyncio.Queue,
+        payloads: asyncio.Queue,
+        executor: ThreadPoolExecutor,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        stats = self.stats["fetch"]
+        while not work.empty():
+            item = work.get_nowait()
+            if self._fetch_start is None:
+                self._fetch_start = perf_counter()
+            payload = await loop.run_in_executor(executor, self._fetch, item)
+            # Fetches overlap, so time the span rather than summing them
+            stats.seconds = perf_counter() - self._fetch_start
+            if payload is None:
+                continue
+            if isinstance(payload, dict):
+                stats.rows += len(payload.get("value", ()))
+            else:
+                stats.bytes += getattr(payload, "size", 0)
+            await payloads.put((item, payload))
+
+    async def _consume(self, payloads: asyncio.Queue) -> None:
+        parse_stats = self.stats["parse"]
+        insert_stats = self.stats["insert"]
+        while True:
+            entry = await payloads.get()
+            if entry is _DONE:
+                return
+            item, payload = entry
+            insert_seconds = insert_stats.seconds
+            start = perf_counter()
+            rows = self._write(item, payload, insert_stats)
+            elapsed = perf_counter() - start
+            parse_stats.seconds += elapsed - (insert_stats.seconds - insert_seconds)
+            parse_stats.rows += rows
+            insert_stats.rows += rows
@@ -0,0 +1,126 @@
+"""Pool of worker threads generating and uploading country datasets"""
+
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from hdx.utilities.path import progress_storing_folder
+from hdx.utilities.retriever import Retrieve
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from .progress import ProgressTracker
+from .retriever_pool import RetrieverPool
+
+logger = logging.getLogger(__name__)
+
+
+class CountryWorkers:
+    """Processes countries in a pool of worker threads. Each worker gets a
+    copy of the populated pipeline with its own read-only session on the
+    SQLite database and its own retriever, so that workers only share the
+    dictionaries and caches built by populate_db, which they do not modify.
+
+    Progress is stored with a ProgressTracker, so the progress file always
+    holds the first country that has not finished.
+
+    Args:
+        pipeline (Pipeline): Populated pipeline to copy for each worker
+        retriever (Retrieve): Retriever to clone for each worker
+        database_path (str): Path of the SQLite database
+        workers (int): Number of worker threads
+        rate_limit (Optional[Dict]): Rate limit shared by the workers' retrievers. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        retriever: Retrieve,
+        database_path: str,
+        workers: int,
+        rate_limit: Optional[Dict] = None,
+    ):
+        self._pipeline = pipeline
+        self._workers = workers
+        # A file URI of the absolute path, since main passes paths starting
+        # with // that would otherwise be read as a URI authority
+        database_uri = f"{Path(database_path).resolve().as_uri()}?mode=ro"
+        self._engine = create_engine(
+            f"sqlite:///{database_uri}&uri=true", poolclass=NullPool
+        )
+        self._retrievers = RetrieverPool(retriever, workers, rate_limit)
+        self._local = threading.local()
+
+    def get_pipeline(self):
+        """Get the pipeline for the calling worker thread, creating it on
+        first use
+
+        Returns:
+            Pipeline: Pipeline for this thread
+        """
+        pipeline = getattr(self._local, "pipeline", None)
+        if pipeline is None:
+            pipeline = self._pipeline.worker_copy(
+                Session(self._engine), self._retrievers.get_retriever()
+            )
+            self._local.pipeline = pipeline
+        return pipeline
+
+    def run(
+        self,
+        process: Callable[[Any, Dict], None],
+        info: Dict,
+        countries: Iterable[Dict],
+        key: str = "Code",
+    ) -> None:
+        """Call process(pipeline, country) for each country in the worker
+        threads. If a call raises an exception, no more countries are
+        started, the running ones are finished and the exception is raised.
+
+        Args:
+            process (Callable[[Any, Dict], None]): Function to call with the worker's pipeline and a country
+            info (Dict): Dictionary from wheretostart_tempdir_batch
+            countries (Iterable[Dict]): Countries to process
+            key (str): Key of the country code in each country. Defaults to "Code".
+
+        Returns:
+            None
+        """
+        progress = ProgressTracker(info, key)
+        futures = []
+
+        def call(country):
+            process(self.get_pipeline(), country)
+            progress.finish(country[key])
+
+        def running():
+            return [future for future in futures if not future.done()]
+
+        def wait_for_one():
+            wait(running(), return_when=FIRST_COMPLETED)
+            progress.store()
+            for future in futures:
+                if future.done():
+                    future.result()
+
+        executor = ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="country"
+        )
+        try:
+            for _, country in progress_storing_folder(info, countries, key):
+                progress.start(country[key])
+                futures.append(executor.submit(call, country))
+                progress.store()
+                while len(running()) >= self._workers:
+                    wait_for_one()
+            while running():
+                wait_for_one()
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            progress.store()
+            self._retrievers.close()
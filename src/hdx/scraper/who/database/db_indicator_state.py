@@ -0,0 +1,12 @@
+from hdx.database.no_timezone import Base as NoTZBase
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+class DBIndicatorState(NoTZBase):
+    __tablename__ = "indicator_state"
+    code: Mapped[str] = mapped_column(primary_key=True)
+    indicator_name: Mapped[str] = mapped_column(nullable=True)
+    indicator_url: Mapped[str] = mapped_column(nullable=True)
+    etag: Mapped[str] = mapped_column(nullable=True)
+    last_modified: Mapped[str] = mapped_column(nullable=True)
+    digest: Mapped[str] = mapped_column(nullable=True)
@@ -0,0 +1,319 @@
+"""Single pass export of the indicator data of all countries to CSV files"""
+
+import csv
+import logging
+import os
+from functools import lru_cache
+from os.path import join
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from slugify import slugify
+from sqlalchemy import select
+
+from .database.db_indicator_data import DBIndicatorData
+
+logger = logging.getLogger(__name__)
+
+# Columns of indicator_data in the order of the CSV headers
+_EXPORT_COLUMNS = (
+    DBIndicatorData.indicator_code,
+    DBIndicatorData.indicator_name,
+    DBIndicatorData.indicator_url,
+    DBIndicatorData.year,
+    DBIndicatorData.start_year,
+    DBIndicatorData.end_year,
+    DBIndicatorData.region_code,
+    DBIndicatorData.region_display,
+    DBIndicatorData.country_code,
+    DBIndicatorData.country_display,
+    DBIndicatorData.dimension_type,
+    DBIndicatorData.dimension_code,
+    DBIndicatorData.dimension_name,
+    DBIndicatorData.numeric,
+    DBIndicatorData.value,
+    DBIndicatorData.low,
+    DBIndicatorData.high,
+)
+_YEAR_INDEX = 3
+_COUNTRY_INDEX = 8
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, OSError, ValueError):
+    _PAGE_SIZE = 4096
+
+
+def current_rss() -> Optional[int]:
+    """Resident memory of the process read from /proc
+
+    Returns:
+        Optional[int]: Resident memory in bytes or None where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def _category_slug(category_name: str) -> str:
+    return slugify(category_name, separator="_")
+
+
+def category_filename(category_name: str, country_iso3: str) -> str:
+    return f"{_category_slug(category_name)}_indicators_{country_iso3.lower()}.csv"
+
+
+def all_indicators_filename(country_iso3: str) -> str:
+    return f"health_indicators_{country_iso3.lower()}.csv"
+
+
+def archived_indicators_filename(country_iso3: str) -> str:
+    return f"historical_health_indicators_{country_iso3.lower()}.csv"
+
+
+class _LastLine:
+    """File-like target of a csv.writer that keeps the last line written,
+    which is the whole of the last row since csv.writer writes a row with
+    one call"""
+
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text: str) -> None:
+        self.text = text
+
+
+class RowEncoder:
+    """Encodes rows to UTF-8 CSV lines with CRLF line endings, the format
+    written by Dataset.generate_resource_from_iterable"""
+
+    def __init__(self):
+        self._line = _LastLine()
+        self._writer = csv.writer(self._line, lineterminator="\r\n")
+
+    def encode(self, row) -> bytes:
+        self._writer.writerow(row)
+        return self._line.text.encode("utf-8")
+
+
+class ExportedFile:
+    """A CSV file written by the export engine in the same format as
+    Dataset.generate_resource_from_iterable: a header row, an HXL row and
+    the data rows with CRLF line endings. Rows are written as lines already
+    encoded by a RowEncoder, so that a row going to several files is only
+    encoded once. The size of the file is kept when it is closed. The range
+    of truthy years is kept so that the time period of a dataset can be set
+    without rereading it.
+
+    Args:
+        path (str): Path of the file
+        headers (List[str]): Header row
+        hxltags (Dict[str, str]): Header to HXL hashtag mapping
+        encoder (RowEncoder): Encoder for the header rows
+    """
+
+    def __init__(
+        self,
+        path: str,
+        headers: List[str],
+        hxltags: Dict[str, str],
+        encoder: RowEncoder,
+    ):
+        self.path = path
+        self.rows = 0
+        self.bytes = 0
+        self.start_year = None
+        self.end_year = None
+        self._file = open(path, "wb")
+        self._file.write(encoder.encode(headers))
+        self._file.write(encoder.encode([hxltags[header] for header in headers]))
+
+    def write_line(self, line: bytes) -> None:
+        self._file.write(line)
+        self.rows += 1
+
+    def add_year(self, year) -> None:
+        if not year:
+            return
+        if self.start_year is None or year < self.start_year:
+            self.start_year = year
+        if self.end_year is None or year > self.end_year:
+            self.end_year = year
+
+    def close(self) -> None:
+        self.bytes = self._file.tell()
+        self._file.close()
+
+
+class ExportEngine:
+    """Reads the indicator data once, ordered by country, and writes each row
+    to the CSV files of its country that it belongs to: one file per category
+    of the row's indicator plus the all indicators file, or the archived
+    indicators file if the indicator is archived. Only the files of one
+    country are open at a time. Rows of indicators that are in neither
+    indicator_categories nor archived_indicators are skipped, so passing an
+    empty mapping or set skips the corresponding files.
+
+    Args:
+        session: Database session
+        folder (str): Folder to write the files to
+        hxltags (Dict[str, str]): Header to HXL hashtag mapping
+        indicator_categories (Dict[str, List[str]]): Category titles of each indicator that is not archived
+        archived_indicators (Set[str]): Codes of archived indicators
+        store (Optional[ParquetStore]): Read the rows from this store instead of the database. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        session,
+        folder: str,
+        hxltags: Dict[str, str],
+        indicator_categories: Dict[str, List[str]],
+        archived_indicators: Set[str],
+        store=None,
+    ):
+        self._session = session
+        self._store = store
+        self._folder = folder
+        self._hxltags = hxltags
+        self._headers = list(hxltags.keys())
+        self._indicator_categories = indicator_categories
+        self._archived_indicators = archived_indicators
+        self._encoder = RowEncoder()
+        self._peak_rss = 0
+
+    def run(
+        self, country_iso3: Optional[str] = None
+    ) -> Dict[str, Dict[str, ExportedFile]]:
+        """Write the files of all countries or of one country
+
+        Args:
+            country_iso3 (Optional[str]): Only write the files of this country. Defaults to None (all countries).
+
+        Returns:
+            Dict[str, Dict[str, ExportedFile]]: Written files by filename by country
+        """
+        start = perf_counter()
+        exported = dict()
+        if self._store:
+            rows = self._store.iter_rows(
+                [column.name for column in _EXPORT_COLUMNS], country_iso3
+            )
+        else:
+            query = select(*_EXPORT_COLUMNS)
+            if country_iso3:
+                query = query.where(DBIndicatorData.country_code == country_iso3)
+            rows = self._fetch_tuples(
+                query.order_by(DBIndicatorData.country_code, DBIndicatorData.id)
+            )
+        encode = self._encoder.encode
+        nrows = 0
+        current_iso3 = None
+        country_rows = 0
+        files = dict()
+        targets = dict()
+        for row in rows:
+            if row[_COUNTRY_INDEX] != current_iso3:
+                self._finish_country(current_iso3, files, country_rows)
+                nrows += country_rows
+                current_iso3 = row[_COUNTRY_INDEX]
+                country_rows = 0
+                files = exported.setdefault(current_iso3, dict())
+                targets = dict()
+            indicator_code = row[0]
+            row_targets = targets.get(indicator_code)
+            if row_targets is None:
+                row_targets = self._get_targets(current_iso3, files, indicator_code)
+                targets[indicator_code] = row_targets
+            if not row_targets:
+                continue
+            line = encode(row)
+            for file in row_targets:
+                file.write_line(line)
+            # The last file is the all indicators or archived indicators file
+            row_targets[-1].add_year(row[_YEAR_INDEX])
+            country_rows += 1
+        self._finish_country(current_iso3, files, country_rows)
+        nrows += country_rows
+        nfiles = sum(len(files) for files in exported.values())
+        logger.info(
+            f"Exported {nrows} rows to {nfiles} files for {len(exported)} "
+            f"countries in {perf_counter() - start:.1f}s"
+        )
+        return exported
+
+    def _fetch_tuples(self, query, batch_size: int = 10000) -> Iterator[Tuple]:
+        """Rows of a query as the plain tuples of the DBAPI cursor rather than
+        SQLAlchemy Row objects, which halves the cost of reading them"""
+        connection = self._session.connection()
+        compiled = query.compile(dialect=connection.dialect)
+        if compiled.positiontup is None:
+            params = compiled.params
+        else:
+            params = [compiled.params[name] for name in compiled.positiontup]
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(str(compiled), params)
+            while batch := cursor.fetchmany(batch_size):
+                yield from batch
+                # Only one batch is held at a time, so sampling after each
+                # one catches the peak
+                self._sample_rss()
+        finally:
+            cursor.close()
+
+    def _sample_rss(self) -> None:
+        rss = current_rss()
+        if rss is not None and rss > self._peak_rss:
+            self._peak_rss = rss
+
+    def _finish_country(self, country_iso3, files, country_rows) -> None:
+        """Close the files of a country and log its rows and the peak resident
+        memory of the process while it was exported"""
+        self._close(files.values())
+        if country_iso3 is None:
+            return
+        self._sample_rss()
+        if self._peak_rss:
+            peak = f", peak RSS {self._peak_rss / 1048576:.0f} MB"
+        else:
+            peak = ""
+        logger.info(
+            f"Exported {country_rows} rows to {len(files)} files for "
+            f"{country_iso3}{peak}"
+        )
+        self._peak_rss = 0
+
+    def _get_targets(self, country_iso3, files, indicator_code):
+        """Files of a country that the rows of an indicator are written to"""
+        category_names = self._indicator_categories.get(indicator_code)
+        if category_names is not None:
+            filenames = [
+                category_filename(category_name, country_iso3)
+                for category_name in category_names
+            ]
+            filenames.append(all_indicators_filename(country_iso3))
+        elif indicator_code in self._archived_indicators:
+            filenames = [archived_indicators_filename(country_iso3)]
+        else:
+            return ()
+        return tuple(self._get_file(files, filename) for filename in filenames)
+
+    def _get_file(self, files, filename) -> ExportedFile:
+        file = files.get(filename)
+        if file is None:
+            file = ExportedFile(
+                join(self._folder, filename),
+                self._headers,
+                self._hxltags,
+                self._encoder,
+            )
+            files[filename] = file
+        return file
+
+    @staticmethod
+    def _close(files: Iterable[ExportedFile]) -> None:
+        for file in files:
+            file.close()
@@ -0,0 +1,158 @@
+"""Indicator payloads downloaded to disk"""
+
+import hashlib
+import json
+from os import remove
+from os.path import exists, getsize, join
+from typing import Dict, Iterator, Optional
+
+import ijson
+from hdx.utilities.base_downloader import DownloadError
+from hdx.utilities.retriever import Retrieve
+from requests import RequestException
+
+_CHUNK_SIZE = 65536
+
+
+class IndicatorFile:
+    """An indicator payload saved to disk along with the HTTP validators
+    and digest used to tell whether it changed since the last run. If the
+    payload is unchanged, path can be None.
+
+    Args:
+        path (Optional[str]): Path of the downloaded file
+        temporary (bool): Whether to delete the file once read
+        etag (Optional[str]): ETag response header. Defaults to None.
+        last_modified (Optional[str]): Last-Modified response header. Defaults to None.
+        digest (Optional[str]): SHA-256 of the file contents. Defaults to None.
+        changed (bool): Whether the payload changed since the last run. Defaults to True.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str],
+        temporary: bool,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        digest: Optional[str] = None,
+        changed: bool = True,
+    ):
+        self.path = path
+        self.temporary = temporary
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.changed = changed
+
+    @property
+    def size(self) -> int:
+        """Size of the file in bytes, 0 if there is none"""
+        if self.path and exists(self.path):
+            return getsize(self.path)
+        return 0
+
+    def values(self, stream: bool) -> Iterator[Dict]:
+        """Iterate over the "value" rows of the payload, removing the file
+        afterwards if it is temporary. If stream is True, rows are parsed one
+        at a time so that memory use does not depend on the file size.
+
+        Args:
+            stream (bool): Whether to parse the file incrementally
+
+        Returns:
+            Iterator[Dict]: Rows of the payload
+        """
+        try:
+            with open(self.path, "rb") as fp:
+                if stream:
+                    yield from ijson.items(fp, "value.item", use_float=True)
+                else:
+                    yield from json.load(fp)["value"]
+        finally:
+            self.remove()
+
+    def remove(self) -> None:
+        if self.temporary and self.path and exists(self.path):
+            remove(self.path)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_indicator_file(
+    retriever: Retrieve, url: str, state: Optional[Dict] = None
+) -> IndicatorFile:
+    """Download an indicator to disk. If state from a previous run is given,
+    a conditional request is made with its ETag and Last-Modified values and
+    the payload digest is compared with the stored one. When using saved
+    data, only the digest is compared.
+
+    Args:
+        retriever (Retrieve): Retriever to use
+        url (str): Indicator URL
+        state (Optional[Dict]): Stored etag, last_modified and digest. Defaults to None.
+
+    Returns:
+        IndicatorFile: The downloaded indicator
+    """
+    filename, _ = retriever.get_filename(url, None, ("json",))
+    if retriever.use_saved:
+        path = join(retriever.saved_dir, filename)
+        if not exists(path):
+            raise FileNotFoundError(path)
+        digest = _file_digest(path)
+        changed = state is None or digest != state["digest"]
+        return IndicatorFile(path, False, digest=digest, changed=changed)
+
+    headers = {}
+    if state:
+        if state["etag"]:
+            headers["If-None-Match"] = state["etag"]
+        if state["last_modified"]:
+            headers["If-Modified-Since"] = state["last_modified"]
+    response = retriever.downloader.setup(url, headers=headers)
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if response.status_code == 304:
+        return IndicatorFile(
+            None,
+            False,
+            etag or state["etag"],
+            last_modified or state["last_modified"],
+            state["digest"],
+            changed=False,
+        )
+
+    if retriever.save:
+        path = join(retriever.saved_dir, filename)
+    else:
+        path = join(retriever.temp_dir, filename)
+    digest = hashlib.sha256()
+    try:
+        with open(path, "wb") as fp:
+            for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                fp.write(chunk)
+                digest.update(chunk)
+    except RequestException as ex:
+        # Raise the error the caller handles, so the stored state is kept
+        if exists(path):
+            remove(path)
+        raise DownloadError(f"Download of {url} failed in retrieving file!") from ex
+    digest = digest.hexdigest()
+    indicator_file = IndicatorFile(
+        path,
+        not retriever.save,
+        etag,
+        last_modified,
+        digest,
+        changed=state is None or digest != state["digest"],
+    )
+    if not indicator_file.changed:
+        indicator_file.remove()
+        indicator_file.path = None
+    return indicator_file
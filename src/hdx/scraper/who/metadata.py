@@ -0,0 +1,127 @@
+"""Metadata that is the same for every country, built once per run"""
+
+import logging
+import re
+from collections import OrderedDict
+from copy import deepcopy
+from os.path import join
+from time import perf_counter
+from typing import Iterable, List
+
+from hdx.data.dataset import Dataset
+from hdx.data.vocabulary import Vocabulary
+from hdx.utilities.dictandlist import merge_two_dictionaries
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import script_dir_plus_file
+
+from .database.db_categories import DBCategories
+from .database.db_indicators import DBIndicators
+
+logger = logging.getLogger(__name__)
+
+_TAG_CLEAN_TABLE = str.maketrans(
+    {
+        "(": "",
+        ")": "",
+        "/": "",
+        ",": "",
+    }
+)
+
+
+def _clean_tag(s: str) -> str:
+    """Remove punctuation used by old multiple_replace and trim whitespace."""
+    return s.translate(_TAG_CLEAN_TABLE).strip()
+
+
+class RunMetadata:
+    """Category titles, resource descriptions, tag mappings and static
+    dataset metadata. None of these depend on the country, so they are
+    read from the database, the vocabulary and the static YAML file once
+    instead of for every dataset.
+
+    Args:
+        session: Database session
+    """
+
+    def __init__(self, session):
+        start = perf_counter()
+        self.category_names = [
+            row.title for row in session.query(DBCategories.title).distinct().all()
+        ]
+        self.categories_str = ", ".join(self.category_names)
+        indicator_links = {category_name: [] for category_name in self.category_names}
+        for row in (
+            session.query(DBCategories.title, DBIndicators.title, DBIndicators.url)
+            .join(DBIndicators, DBIndicators.code == DBCategories.indicator_code)
+            .order_by(DBIndicators.code)
+        ):
+            indicator_links[row[0]].append(f"[{row[1]}]({row[2]})")
+        self.category_descriptions = {
+            category_name: f"*{category_name}:*\n{', '.join(links)}"
+            for category_name, links in indicator_links.items()
+        }
+        self._category_tags = dict()
+        self.static_metadata = load_yaml(
+            script_dir_plus_file(join("config", "hdx_dataset_static.yaml"), RunMetadata)
+        )
+        logger.info(f"Built run metadata in {perf_counter() - start:.1f}s")
+
+    @staticmethod
+    def _map_tags(category_name: str) -> List[str]:
+        tags = []
+        for part in re.split(r"\s+and\s+", category_name, flags=re.IGNORECASE):
+            cleaned = _clean_tag(part)
+            if cleaned:
+                tags.append(cleaned)
+        tags, _ = Vocabulary.get_mapped_tags(tags)
+        return tags
+
+    def get_category_tags(self, category_name: str) -> List[str]:
+        """Mapped tags of a category. Mapping needs the HDX tags vocabulary,
+        so it is done when the tags of a category are first needed rather
+        than when the metadata is built.
+
+        Args:
+            category_name (str): Category title
+
+        Returns:
+            List[str]: Mapped tags
+        """
+        tags = self._category_tags.get(category_name)
+        if tags is None:
+            tags = self._map_tags(category_name)
+            self._category_tags[category_name] = tags
+        return tags
+
+    def get_tags(self, category_names: Iterable[str]) -> List[str]:
+        """Mapped tags of the given categories in the order of
+        category_names, without duplicates
+
+        Args:
+            category_names (Iterable[str]): Category titles
+
+        Returns:
+            List[str]: Mapped tags
+        """
+        category_names = set(category_names)
+        tags = []
+        for category_name in self.category_names:
+            if category_name in category_names:
+                tags.extend(self.get_category_tags(category_name))
+        return list(OrderedDict.fromkeys(tags).keys())
+
+    def update_from_static_metadata(self, dataset: Dataset) -> None:
+        """Update a dataset with the static metadata, like
+        Dataset.update_from_yaml does with the YAML file
+
+        Args:
+            dataset (Dataset): Dataset to update
+
+        Returns:
+            None
+        """
+        dataset.data = merge_two_dictionaries(
+            dataset.data, deepcopy(self.static_metadata)
+        )
+        dataset.separate_resources()
@@ -0,0 +1,290 @@
+"""Counters and durations of a run, reported as JSON and as a textfile for
+the node exporter"""
+
+import itertools
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import replace
+from time import perf_counter, time
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from hdx.utilities.saver import save_json
+from requests import Response, Session
+
+logger = logging.getLogger(__name__)
+
+_PREFIX = "who_"
+
+_HELP = {
+    "http_requests": "HTTP requests made through the download session",
+    "http_response_bytes": "Bytes of HTTP responses read over the network",
+    "db_rows_written": "Rows written to the database or data store",
+    "csv_bytes": "Bytes of CSV files exported",
+    "stage": "Time taken by a stage of the run",
+    "country_generate": "Time taken to generate the datasets of a country",
+    "country_upload": "Time taken to upload the datasets of a country",
+    "run_success": "1 if the run finished without errors, 0 otherwise",
+    "run_timestamp_seconds": "Time the run finished",
+}
+
+
+def _labels_key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+
+class RunMetrics:
+    """Collects counters, gauges and durations of a run, each with optional
+    labels, and writes them as a JSON report and as a textfile in the
+    Prometheus text exposition format read by the node exporter's textfile
+    collector. Durations are summaries: how many times something was timed
+    and the total and longest time it took. The textfile is written to a
+    temporary file and renamed so that the exporter never reads a partial
+    file. Can be used from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._gauges = dict()
+        self._durations = dict()
+        self._pending_responses = dict()
+        self._response_ids = itertools.count()
+        self._started = time()
+
+    def add(self, name: str, value: float = 1, **labels: str) -> None:
+        """Add to a counter
+
+        Args:
+            name (str): Counter name
+            value (float): Amount to add. Defaults to 1.
+            **labels (str): Labels of the counter
+
+        Returns:
+            None
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge
+
+        Args:
+            name (str): Gauge name
+            value (float): Value
+            **labels (str): Labels of the gauge
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        """Record a duration
+
+        Args:
+            name (str): Duration name
+            seconds (float): Duration in seconds
+            **labels (str): Labels of the duration
+
+        Returns:
+            None
+        """
+        key = (name, _labels_key(labels))
+        with self._lock:
+            count, total, longest = self._durations.get(key, (0, 0.0, 0.0))
+            self._durations[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def time(self, name: str, **labels: str):
+        """Record the duration of the block, whether or not it raises
+
+        Args:
+            name (str): Duration name
+            **labels (str): Labels of the duration
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def instrument_session(self, session: Session) -> None:
+        """Count the requests made with a requests session and the bytes of
+        their responses by host. Responses are usually streamed, so their
+        bytes are only known once they have been read: they are counted when
+        the response is garbage collected or when the report is written,
+        whichever comes first.
+
+        Args:
+            session (Session): requests session
+
+        Returns:
+            None
+        """
+        session.hooks["response"].append(self._count_response)
+
+    def _count_response(self, response: Response, *args, **kwargs) -> None:
+        host = urlsplit(response.url).hostname or ""
+        self.add("http_requests", host=host)
+        response_id = next(self._response_ids)
+        finalizer = weakref.finalize(
+            response, self._count_response_bytes, response_id, response.raw, host
+        )
+        with self._lock:
+            self._pending_responses[response_id] = finalizer
+
+    def _count_response_bytes(self, response_id: int, raw, host: str) -> None:
+        with self._lock:
+            self._pending_responses.pop(response_id, None)
+        try:
+            nbytes = raw.tell()
+        except (AttributeError, OSError, ValueError):
+            return
+        self.add("http_response_bytes", nbytes, host=host)
+
+    def _count_pending_responses(self) -> None:
+        with self._lock:
+            finalizers = list(self._pending_responses.values())
+            self._pending_responses = dict()
+        for finalizer in finalizers:
+            # Only counts responses that have not been collected yet
+            finalizer()
+
+    def get_report(self) -> Dict:
+        """Report of the metrics
+
+        Returns:
+            Dict: Start, end and elapsed time of the run and the counters, gauges and durations with their labels
+        """
+        self._count_pending_responses()
+        finished = time()
+
+        def samples(values: Dict, to_dict) -> Dict[str, List[Dict]]:
+            result = dict()
+            for (name, labels), value in sorted(values.items()):
+                result.setdefault(name, []).append(
+                    {"labels": dict(labels), **to_dict(value)}
+                )
+            return result
+
+        with self._lock:
+            return {
+                "started": datetime.fromtimestamp(
+                    self._started, timezone.utc
+                ).isoformat(),
+                "finished": datetime.fromtimestamp(finished, timezone.utc).isoformat(),
+                "elapsed_seconds": round(finished - self._started, 3),
+                "counters": samples(self._counters, lambda value: {"value": value}),
+                "gauges": samples(self._gauges, lambda value: {"value": value}),
+                "durations": samples(
+                    self._durations,
+                    lambda value: {
+                        "count": value[0],
+                        "seconds": round(value[1], 3),
+                        "max_seconds": round(value[2], 3),
+                    },
+                ),
+            }
+
+    def get_textfile(self) -> str:
+        """The metrics in the Prometheus text exposition format. Durations
+        are summaries named {name}_seconds with a companion gauge
+        {name}_max_seconds.
+
+        Returns:
+            str: Textfile contents
+        """
+        self._count_pending_responses()
+        lines = []
+
+        def family(name: str, metric_type: str, help_text: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        def grouped(values: Dict) -> Dict[str, List]:
+            result = dict()
+            for (name, labels), value in sorted(values.items()):
+                result.setdefault(name, []).append((labels, value))
+            return result
+
+        with self._lock:
+            counters = grouped(self._counters)
+            gauges = grouped(self._gauges)
+            durations = grouped(self._durations)
+        for name, samples in counters.items():
+            metric = f"{_PREFIX}{name}_total"
+            family(metric, "counter", _HELP.get(name, name))
+            for labels, value in samples:
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for name, samples in gauges.items():
+            metric = f"{_PREFIX}{name}"
+            family(metric, "gauge", _HELP.get(name, name))
+            for labels, value in samples:
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+        for name, samples in durations.items():
+            metric = f"{_PREFIX}{name}_seconds"
+            family(metric, "summary", _HELP.get(name, name))
+            for labels, (count, total, _) in samples:
+                lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+            metric = f"{_PREFIX}{name}_max_seconds"
+            family(metric, "gauge", f"Longest of {_PREFIX}{name}_seconds")
+            for labels, (_, _, longest) in samples:
+                lines.append(f"{metric}{_format_labels(labels)} {longest:.6f}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    @contextmanager
+    def report(self, json_path: str, textfile_path: str):
+        """Save the metrics when the block exits, with the run_success gauge
+        set to 0 if it raised and 1 otherwise
+
+        Args:
+            json_path (str): Path of the JSON report
+            textfile_path (str): Path of the textfile
+
+        Returns:
+            RunMetrics: These metrics
+        """
+        success = 0
+        try:
+            yield self
+            success = 1
+        finally:
+            self.set("run_success", success)
+            self.set("run_timestamp_seconds", round(time()))
+            self.save(json_path, textfile_path)
+
+    def save(self, json_path: str, textfile_path: str) -> None:
+        """Save the JSON report and the textfile
+
+        Args:
+            json_path (str): Path of the JSON report
+            textfile_path (str): Path of the textfile, which should end in .prom for the node exporter
+
+        Returns:
+            None
+        """
+        save_json(self.get_report(), json_path)
+        temporary_path = f"{textfile_path}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.get_textfile())
+        replace(temporary_path, textfile_path)
+        logger.info(f"Saved run metrics to {json_path} and {textfile_path}")
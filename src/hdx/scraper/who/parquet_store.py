@@ -0,0 +1,228 @@
+"""Columnar store for the indicator data as a Parquet dataset partitioned by
+country"""
+
+import logging
+import shutil
+from os import listdir, remove
+from os.path import exists
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .database.db_indicator_data import DBIndicatorData
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Rows buffered before a row group is written to the staging file
+_ROW_GROUP_SIZE = 65536
+
+
+def _real_text(value: float) -> str:
+    """Format a float like SQLite does when storing it in a text column"""
+    text = f"{value:.15g}"
+    if text in ("inf", "-inf", "nan"):
+        return text
+    mantissa, e, exponent = text.partition("e")
+    if "." not in mantissa:
+        mantissa = f"{mantissa}.0"
+    if mantissa == "-0.0":
+        mantissa = "0.0"
+    if e:
+        return f"{mantissa}e{exponent}"
+    return mantissa
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return _real_text(value)
+    return str(value)
+
+
+def _to_int(value):
+    if value is None:
+        return None
+    return int(value)
+
+
+def _to_float(value):
+    if value is None:
+        return None
+    return float(value)
+
+
+class ParquetStore:
+    """Stores the indicator data in a Parquet dataset partitioned by country
+    instead of the indicator_data table. Column batches are appended to a
+    staging file while the indicators are loaded. finish then rewrites the
+    staging file as one directory of Parquet files per country, so that
+    reading a country only opens that country's files (partition pruning)
+    and only the requested columns are decoded (column pruning).
+
+    Values are converted to the types of the indicator_data columns the way
+    SQLite converts them when storing them, so exports from either store are
+    identical. Rows are assumed to have unique ids: unlike the upsert into
+    SQLite, writing a row twice stores it twice.
+
+    Requires pyarrow, which can be installed with the parquet extra.
+
+    Args:
+        folder (str): Folder for the dataset, which is replaced if it exists
+    """
+
+    def __init__(self, folder: str):
+        if pa is None:
+            raise ImportError(
+                "pyarrow not found! Please install hdx-scraper-who[parquet] to "
+                "use the Parquet store."
+            )
+        self._folder = folder
+        self._staging_path = f"{folder}.staging.parquet"
+        columns = DBIndicatorData.__table__.columns
+        self._columns = [column.name for column in columns]
+        self._converters = dict()
+        fields = []
+        for column in columns:
+            python_type = column.type.python_type
+            if python_type is int:
+                fields.append(pa.field(column.name, pa.int64()))
+                self._converters[column.name] = _to_int
+            elif python_type is float:
+                fields.append(pa.field(column.name, pa.float64()))
+                self._converters[column.name] = _to_float
+            else:
+                fields.append(pa.field(column.name, pa.string()))
+                self._converters[column.name] = _to_text
+        self._schema = pa.schema(fields)
+        self._writer = None
+        self._buffer = {name: [] for name in self._columns}
+        self._buffered = 0
+
+    def write(self, batch: Dict[str, Sequence]) -> None:
+        """Append a column batch of indicator_data rows
+
+        Args:
+            batch (Dict[str, Sequence]): Values of each indicator_data column
+
+        Returns:
+            None
+        """
+        for name in self._columns:
+            self._buffer[name].extend(map(self._converters[name], batch[name]))
+        self._buffered += len(batch["id"])
+        if self._buffered >= _ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._staging_path, self._schema)
+        if self._buffered:
+            self._writer.write_table(
+                pa.table(
+                    [
+                        pa.array(self._buffer[name], type=field.type)
+                        for name, field in zip(self._columns, self._schema)
+                    ],
+                    schema=self._schema,
+                )
+            )
+        self._buffer = {name: [] for name in self._columns}
+        self._buffered = 0
+
+    def finish(self) -> None:
+        """Partition the staged rows by country into the dataset folder
+
+        Returns:
+            None
+        """
+        start = perf_counter()
+        self._flush()
+        self._writer.close()
+        self._writer = None
+        if exists(self._folder):
+            shutil.rmtree(self._folder)
+        ds.write_dataset(
+            ds.dataset(self._staging_path, format="parquet"),
+            self._folder,
+            format="parquet",
+            partitioning=ds.partitioning(
+                pa.schema([self._schema.field("country_code")]), flavor="hive"
+            ),
+            max_partitions=4096,
+        )
+        remove(self._staging_path)
+        logger.info(f"Partitioned Parquet store in {perf_counter() - start:.1f}s")
+
+    def _dataset(self):
+        return ds.dataset(
+            self._folder,
+            schema=self._schema,
+            format="parquet",
+            partitioning="hive",
+        )
+
+    def get_countries(self) -> List[str]:
+        """Countries with data in the store
+
+        Returns:
+            List[str]: Sorted country codes
+        """
+        if not exists(self._folder):
+            return []
+        return sorted(
+            name.partition("=")[2]
+            for name in listdir(self._folder)
+            if name.startswith("country_code=")
+        )
+
+    def get_country_indicators(self) -> Iterator[Tuple[str, str]]:
+        """Distinct pairs of country and indicator in the store
+
+        Returns:
+            Iterator[Tuple[str, str]]: (country code, indicator code)
+        """
+        if not exists(self._folder):
+            return
+        # Each file belongs to one country, so only the distinct indicators
+        # of each file are needed
+        for fragment in self._dataset().get_fragments():
+            country = ds.get_partition_keys(fragment.partition_expression)[
+                "country_code"
+            ]
+            indicator_codes = pc.unique(
+                fragment.to_table(columns=["indicator_code"]).column(0)
+            )
+            for indicator_code in indicator_codes.to_pylist():
+                yield country, indicator_code
+
+    def iter_rows(
+        self, columns: Sequence[str], country_iso3: Optional[str] = None
+    ) -> Iterator[Tuple]:
+        """Rows of the given columns as tuples ordered by country and id,
+        reading one country at a time
+
+        Args:
+            columns (Sequence[str]): Names of the columns to read
+            country_iso3 (Optional[str]): Only read this country. Defaults to None (all countries).
+
+        Returns:
+            Iterator[Tuple]: Rows
+        """
+        countries = self.get_countries()
+        if country_iso3:
+            countries = [country_iso3] if country_iso3 in countries else []
+        dataset = self._dataset()
+        for country in countries:
+            table = dataset.to_table(
+                columns=list(columns) + ["id"],
+                filter=ds.field("country_code") == country,
+            ).sort_by("id")
+            yield from zip(*(table.column(name).to_pylist() for name in columns))
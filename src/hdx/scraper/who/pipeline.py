@@ -2,56 +2,146 @@
 """Who scraper"""
 
 import logging
-import re
-from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from copy import copy
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from os.path import exists, join
+from time import perf_counter
+from typing import Optional
 from urllib.parse import quote
 
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from hdx.data.hdxobject import HDXError
+from hdx.data.resource import Resource
 from hdx.data.showcase import Showcase
-from hdx.data.vocabulary import Vocabulary
 from hdx.location.country import Country
 from hdx.utilities.base_downloader import DownloadError
 from hdx.utilities.dateparse import parse_date_range
 from hdx.utilities.retriever import Retrieve
 from slugify import slugify
-from sqlalchemy import false, true
-from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import delete, event, false, insert, select, true, update
 
+from .async_ingest import AsyncIngest
 from .database.db_categories import DBCategories
 from .database.db_dimension_values import DBDimensionValues
 from .database.db_dimensions import DBDimensions
 from .database.db_indicator_data import DBIndicatorData
+from .database.db_indicator_state import DBIndicatorState
 from .database.db_indicators import DBIndicators
+from .export import (
+    ExportEngine,
+    all_indicators_filename,
+    archived_indicators_filename,
+    category_filename,
+)
+from .indicator_file import IndicatorFile, download_indicator_file
+from .metadata import RunMetadata
+from .metrics import RunMetrics
+from .parquet_store import ParquetStore
+from .retriever_pool import RetrieverPool
+from .url_probe import UrlProbe
 
 logger = logging.getLogger(__name__)
 
 _BATCH_SIZE = 1000
-_TAG_CLEAN_TABLE = str.maketrans(
-    {
-        "(": "",
-        ")": "",
-        "/": "",
-        ",": "",
-    }
+
+
+# Fields of an API row in the order unpacked by Pipeline._transform_batch
+_API_ROW_FIELDS = itemgetter(
+    "Id",
+    "TimeDim",
+    "TimeDimensionBegin",
+    "TimeDimensionEnd",
+    "ParentLocationCode",
+    "ParentLocation",
+    "SpatialDim",
+    "Dim1Type",
+    "Dim1",
+    "NumericValue",
+    "Value",
+    "Low",
+    "High",
 )
 
 
-def _clean_tag(s: str) -> str:
-    """Remove punctuation used by old multiple_replace and trim whitespace."""
-    return s.translate(_TAG_CLEAN_TABLE).strip()
+@lru_cache(maxsize=4096)
+def _year_from_timestamp(timestamp: str) -> str:
+    """Year of an API timestamp. There are few distinct timestamps so the
+    parsing is cached."""
+    return datetime.fromisoformat(timestamp).strftime("%Y")
+
+
+# Columns of indicator_data in the order of the column batches built by
+# Pipeline._transform_batch
+_INDICATOR_DATA_COLUMNS = tuple(
+    column.name for column in DBIndicatorData.__table__.columns
+)
+_UPSERT_SQL = (
+    f"INSERT INTO {DBIndicatorData.__tablename__} "
+    f"({', '.join(_INDICATOR_DATA_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(_INDICATOR_DATA_COLUMNS))}) "
+    f"ON CONFLICT (id) DO UPDATE SET "
+    + ", ".join(
+        f"{column} = excluded.{column}" for column in _INDICATOR_DATA_COLUMNS[1:]
+    )
+)
+# Built by Pipeline._create_indexes once the indicator data is loaded so
+# that the inserts do not pay for index maintenance
+_SECONDARY_INDEXES = (
+    (DBIndicatorData.__tablename__, "country_code"),
+    (DBIndicators.__tablename__, "to_archive"),
+)
+# Applied to every connection while bulk loading a fresh database. A failed
+# load is rebuilt from scratch so durability is traded for speed.
+_BULK_LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": "-65536",
+    "temp_store": "MEMORY",
+}
 
 
 class Pipeline:
     def __init__(
-        self, configuration: Configuration, retriever: Retrieve, tempdir: str, session
+        self,
+        configuration: Configuration,
+        retriever: Retrieve,
+        tempdir: str,
+        session,
+        download_workers: int = 1,
+        stream_json: bool = False,
+        incremental: bool = False,
+        url_probe: Optional[UrlProbe] = None,
+        data_store: str = "sqlite",
+        metrics: Optional[RunMetrics] = None,
     ):
         self._configuration = configuration
         self._retriever = retriever
         self._tempdir = tempdir
         self._session = session
+        self._download_workers = download_workers
+        self._stream_json = stream_json
+        self._incremental = incremental
+        self._url_probe = url_probe
+        self._metrics = metrics or RunMetrics()
+        if data_store == "parquet":
+            if incremental:
+                raise ValueError("Incremental refresh needs the sqlite data store")
+            self._parquet_store = ParquetStore(join(tempdir, "indicator_data"))
+        elif data_store == "sqlite":
+            self._parquet_store = None
+        else:
+            raise ValueError(f"Unknown data store {data_store}")
+        self._indicator_states = dict()
+        self._exported_files = None
+        self._coverage = dict()
+        self._indicator_categories = dict()
+        self._metadata = None
+        self._refresh_summary = {"refreshed": 0, "skipped": 0}
         self._dimension_value_names_dict = dict()
         self._hxltags = {
             "GHO (CODE)": "#indicator+code",
@@ -73,60 +163,147 @@ class Pipeline:
             "High": "#indicator+value+high",
         }
 
-    def populate_db(self, populate_db: bool, create_archived_datasets: bool):
+    def populate_db(
+        self,
+        populate_db: bool,
+        create_archived_datasets: bool,
+        async_ingest: bool = False,
+    ):
         """Populate the database and create convenience dictionaries and
         lists
 
         Args:
             populate_db (bool): populate the database
+            async_ingest (bool): use the asyncio ingest engine for indicator data
 
         Returns:
             None
         """
         if populate_db:
-            self._populate_dimensions_db()
+            if self._incremental:
+                self._clear_reference_db()
+            with self._metrics.time("stage", stage="populate_dimensions"):
+                self._populate_dimensions_db()
         # This dictionary is needed for populating the other DBs
         self._create_dimension_value_names_dict()
         self._create_countries_dict()
         if populate_db:
-            self._populate_categories_and_indicators_db()
-            self._populate_indicator_data_db(create_archived_datasets)
+            with self._metrics.time("stage", stage="populate_categories"):
+                self._populate_categories_and_indicators_db()
+            if self._incremental:
+                self._remove_unlisted_indicators()
+                self._load_indicator_states()
+            # Without incremental refresh the database is always new
+            with (
+                self._metrics.time("stage", stage="populate_indicator_data"),
+                nullcontext() if self._incremental else self._bulk_load(),
+            ):
+                if async_ingest:
+                    self._populate_indicator_data_db_async(create_archived_datasets)
+                else:
+                    self._populate_indicator_data_db(create_archived_datasets)
+                if self._parquet_store:
+                    self._parquet_store.finish()
+                else:
+                    self._create_indexes()
+            if self._incremental:
+                logger.info(
+                    f"Incremental refresh: "
+                    f"{self._refresh_summary['refreshed']} indicators refreshed, "
+                    f"{self._refresh_summary['skipped']} unchanged indicators skipped"
+                )
+        with self._metrics.time("stage", stage="coverage"):
+            self._create_coverage()
+        self._metadata = RunMetadata(self._session)
+
+    def worker_copy(self, session, retriever):
+        """Public method that returns a copy of the pipeline using its own
+        database session and retriever, for generating datasets in a worker
+        thread. The dictionaries and caches built by populate_db are shared
+        with the copy and must not be modified."""
+        pipeline = copy(self)
+        pipeline._session = session
+        pipeline._retriever = retriever
+        return pipeline
+
+    def get_metrics(self):
+        """Public method that returns the metrics of the run, which are
+        shared with worker copies"""
+        return self._metrics
+
+    def update_from_static_metadata(self, dataset):
+        """Public method that updates a dataset with the static dataset
+        metadata, read once per run"""
+        self._metadata.update_from_static_metadata(dataset)
+
+    def get_coverage(self):
+        """Public method that returns the titles of the categories with data
+        that is not archived for each country with such data, so that callers
+        can skip countries and categories without data"""
+        return self._coverage
 
     def get_countries(self):
         """Public method that returns countries in the format required
         for progress_starting_folder"""
         return [{"Code": country_iso3} for country_iso3 in self._countries_dict.keys()]
 
+    def _clear_reference_db(self):
+        """In incremental mode the database is kept between runs. The
+        dimension, category and indicator tables are small, so they are
+        emptied and repopulated, while indicator data is only replaced for
+        indicators that changed."""
+        logger.info("Clearing dimensions, categories and indicators DB")
+        for table in (DBCategories, DBDimensionValues, DBDimensions, DBIndicators):
+            self._session.execute(delete(table))
+        self._session.commit()
+
     def _populate_dimensions_db(self):
         """The main API only provides the dimension codes. This method
         queries the dimensions in the API to get their names, that can
-        be used for quickcharts, etc."""
+        be used for quickcharts, etc. The values of the dimensions are
+        downloaded concurrently if there is more than one download worker
+        and all rows are inserted in bulk in one transaction."""
         logger.info("Populating dimensions DB")
+        start = perf_counter()
         dimensions_url = f"{self._configuration['base_url']}api/dimension"
         dimensions_result = self._retriever.download_json(dimensions_url)["value"]
-        for dimensions_row in dimensions_result:
-            dimension_code = dimensions_row["Code"]
-            dimension_title = dimensions_row["Title"]
-
-            db_dimensions_row = DBDimensions(code=dimension_code, title=dimension_title)
-            self._session.add(db_dimensions_row)
-            self._session.commit()
-            dimension_values_url = (
-                f"{self._configuration['base_url']}api/DIMENSION/"
-                f"{dimension_code}/DimensionValues"
-            )
-            dimension_values_result = self._retriever.download_json(
-                dimension_values_url
-            )["value"]
+        dimension_rows = [
+            {"code": dimensions_row["Code"], "title": dimensions_row["Title"]}
+            for dimensions_row in dimensions_result
+        ]
+        dimension_value_rows = []
+        for dimension_code, dimension_values_result in self._download_in_order(
+            self._download_dimension_values,
+            [row["code"] for row in dimension_rows],
+        ):
             for dimension_values_row in dimension_values_result:
-                db_dimension_values_row = DBDimensionValues(
-                    code=dimension_values_row["Code"],
-                    title=dimension_values_row["Title"],
-                    dimension_code=dimension_code,
+                dimension_value_rows.append(
+                    {
+                        "code": dimension_values_row["Code"],
+                        "title": dimension_values_row["Title"],
+                        "dimension_code": dimension_code,
+                    }
                 )
-                self._session.add(db_dimension_values_row)
-            self._session.commit()
-        logger.info("Done populating dimensions DB")
+        if dimension_rows:
+            self._session.execute(insert(DBDimensions), dimension_rows)
+        if dimension_value_rows:
+            self._session.execute(insert(DBDimensionValues), dimension_value_rows)
+        self._session.commit()
+        self._metrics.add("db_rows_written", len(dimension_rows), table="dimensions")
+        self._metrics.add(
+            "db_rows_written", len(dimension_value_rows), table="dimension_values"
+        )
+        logger.info(
+            f"Done populating dimensions DB: {len(dimension_rows)} dimensions and "
+            f"{len(dimension_value_rows)} values in {perf_counter() - start:.1f}s"
+        )
+
+    def _download_dimension_values(self, retriever, dimension_code):
+        dimension_values_url = (
+            f"{self._configuration['base_url']}api/DIMENSION/"
+            f"{dimension_code}/DimensionValues"
+        )
+        return retriever.download_json(dimension_values_url)["value"]
 
     def _create_dimension_value_names_dict(self):
         results = self._session.query(DBDimensionValues).all()
@@ -142,18 +319,22 @@ class Pipeline:
         }
 
     def _populate_categories_and_indicators_db(self):
+        """Populate the indicators and categories in one transaction: the
+        indicators and the deduplicated categories are inserted in bulk,
+        then the indicators with a category are given their URL and
+        marked as not to archive with one bulk update"""
+        start = perf_counter()
         # Get the indicator results
         indicator_url = f"{self._configuration['base_url']}api/indicator"
         indicator_result = self._retriever.download_json(indicator_url)["value"]
-
-        # Loop through all indicators and add to table, checking for duplicates
-        for indicator_row in indicator_result:
-            db_indicators_row = DBIndicators(
-                code=indicator_row["IndicatorCode"],
-                title=indicator_row["IndicatorName"],
-            )
-            self._session.add(db_indicators_row)
-        self._session.commit()
+        indicator_rows = [
+            {
+                "code": indicator_row["IndicatorCode"],
+                "title": indicator_row["IndicatorName"],
+            }
+            for indicator_row in indicator_result
+        ]
+        indicator_codes = {row["code"] for row in indicator_rows}
 
         # Get the category results
         category_url = (
@@ -161,8 +342,11 @@ class Pipeline:
         )
         category_result = self._retriever.download_json(category_url)["value"]
 
-        # Loop through categories and add to category DB table, also
-        # add indicator URL to indicator.
+        # Loop through categories, keeping those that are unique, and collect
+        # the URLs of their indicators
+        category_keys = set()
+        category_rows = []
+        indicator_urls = dict()
         for category_row in category_result:
             # Some indicator codes have "\t" in them on the category page
             # which isn't present in the indicator page, such as RADON_Q602,
@@ -171,237 +355,562 @@ class Pipeline:
             indicator_url = f"https://www.who.int/data/gho/data/indicators/indicator-details/GHO/{quote(category_row['INDICATOR_URL_NAME'])}"
             category_title = category_row["THEME_TITLE"]
 
-            # Add the category to the table
             # Categories can repeat but should be unique in combination with
             # the indicator code, together the title and indicator code make the PK
-            category_plus_indicator_exists = (
-                self._session.query(DBCategories)
-                .filter_by(title=category_title, indicator_code=indicator_code)
-                .first()
-            )
-            if category_plus_indicator_exists:
+            category_key = (category_title, indicator_code)
+            if category_key in category_keys:
                 logger.warning(
                     f"Category {category_title} with indicator {indicator_code} already exists, skipping"
                 )
                 continue
-
-            db_categories_row = DBCategories(
-                title=category_title, indicator_code=indicator_code
+            category_keys.add(category_key)
+            category_rows.append(
+                {"title": category_title, "indicator_code": indicator_code}
             )
-            self._session.add(db_categories_row)
-            self._session.commit()
-            # Add URL to indicator
-            indicator_row = (
-                self._session.query(DBIndicators)
-                .filter(DBIndicators.code == indicator_code)
-                .first()
-            )
-            if not indicator_row:
+            if indicator_code not in indicator_codes:
                 logger.warning(
                     f"Indicator code {indicator_code} was not found on the "
                     f"indicators page"
                 )
                 continue
-            else:
-                indicator_row.url = indicator_url
-                indicator_row.to_archive = False
-            self._session.commit()
+            indicator_urls[indicator_code] = indicator_url
+
+        if indicator_rows:
+            self._session.execute(insert(DBIndicators), indicator_rows)
+        if category_rows:
+            self._session.execute(insert(DBCategories), category_rows)
+        if indicator_urls:
+            self._session.execute(
+                update(DBIndicators),
+                [
+                    {"code": code, "url": url, "to_archive": False}
+                    for code, url in indicator_urls.items()
+                ],
+            )
+        self._session.commit()
+        self._metrics.add("db_rows_written", len(indicator_rows), table="indicators")
+        self._metrics.add("db_rows_written", len(category_rows), table="categories")
+        logger.info(
+            f"Added {len(indicator_rows)} indicators and {len(category_rows)} "
+            f"categories in {perf_counter() - start:.1f}s"
+        )
+
+    def _get_indicator_categories(self):
+        """Titles of the categories of each indicator that is not archived"""
+        indicator_categories = dict()
+        for row in (
+            self._session.query(DBCategories.title, DBCategories.indicator_code)
+            .join(DBIndicators, DBIndicators.code == DBCategories.indicator_code)
+            .filter(DBIndicators.to_archive.is_(false()))
+        ):
+            indicator_categories.setdefault(row.indicator_code, []).append(row.title)
+        return indicator_categories
+
+    def _create_coverage(self):
+        """Record which categories have data that is not archived for each
+        country, from the distinct pairs of country and indicator in the
+        indicator data"""
+        start = perf_counter()
+        self._indicator_categories = self._get_indicator_categories()
+        self._coverage = dict()
+        if self._parquet_store:
+            pairs = self._parquet_store.get_country_indicators()
+        else:
+            pairs = self._session.execute(
+                select(
+                    DBIndicatorData.country_code, DBIndicatorData.indicator_code
+                ).distinct()
+            )
+        for country_code, indicator_code in pairs:
+            category_names = self._indicator_categories.get(indicator_code)
+            if category_names:
+                self._coverage.setdefault(country_code, set()).update(category_names)
+        logger.info(
+            f"Found data for {len(self._coverage)} countries in "
+            f"{perf_counter() - start:.1f}s"
+        )
 
     def _create_tags(self, country_iso3: str, to_archive: bool):
         """Use category titles to create tags"""
         base_tags = ["hxl", "indicators"]
         if to_archive:
             return base_tags
-        tags = []
-
-        # This is done in a roundabout way for speed, doing it as a single sql
-        # query is very slow
-        country_category_names = []
-        all_category_names = [
-            row.title
-            for row in self._session.query(DBCategories.title).distinct().all()
-        ]
-        for category_name in all_category_names:
-            data_exists = (
-                self._session.query(DBIndicatorData)
-                .join(
-                    DBIndicators,
-                    DBIndicators.code == DBIndicatorData.indicator_code,
+        return base_tags + self._metadata.get_tags(
+            self._coverage.get(country_iso3, set())
+        )
+
+    def _download_in_order(self, download, items):
+        """Call download(retriever, item) for each item, yielding
+        (item, result) in the order of items. If there is more than one
+        download worker, the downloads run concurrently in a pool of threads
+        that share the rate limit from the configuration, while the caller
+        (the only database writer) consumes the results."""
+        if self._download_workers <= 1:
+            for item in items:
+                yield item, download(self._retriever, item)
+            return
+        pool = RetrieverPool(
+            self._retriever,
+            self._download_workers,
+            self._configuration.get("rate_limit"),
+        )
+        try:
+            yield from pool.map(download, items)
+        finally:
+            pool.close()
+
+    def _download_indicator(self, retriever, indicator):
+        indicator_code, indicator_name, _ = indicator
+        logger.info(f"Downloading file for indicator {indicator_name}")
+        base_url = self._configuration["base_url"]
+        url = f"{base_url}api/{indicator_code}"
+        try:
+            if self._incremental:
+                return download_indicator_file(
+                    retriever, url, self._indicator_states.get(indicator_code)
                 )
-                .join(
-                    DBCategories,
-                    DBCategories.indicator_code == DBIndicators.code,
+            if not self._stream_json:
+                return retriever.download_json(url)
+            # Only download the file, it is parsed incrementally when written
+            # download_file adds the retriever's prefix to the filename, so
+            # the file has the same name as when downloaded with download_json
+            filename, _ = retriever.get_filename(url, None, ("json",), file_prefix="")
+            path = retriever.download_file(url, filename=filename)
+            if not exists(path):
+                raise FileNotFoundError(path)
+            return IndicatorFile(
+                path, temporary=not retriever.save and not retriever.use_saved
+            )
+        except (DownloadError, FileNotFoundError):
+            logger.warning(f"{url} has no data")
+            return None
+
+    def _indicator_values(self, indicator_json):
+        """Iterate over the "value" rows of an indicator payload. If it was
+        downloaded to a file, rows are read from there, and when streaming
+        they are parsed one at a time so that memory use depends on the
+        batch size rather than the size of the indicator."""
+        if isinstance(indicator_json, IndicatorFile):
+            yield from indicator_json.values(self._stream_json)
+        else:
+            yield from indicator_json["value"]
+
+    def _remove_unlisted_indicators(self):
+        """In incremental mode, delete the data and the stored state of
+        indicators that are no longer listed by the API"""
+        listed = select(DBIndicators.code)
+        nrows = self._session.execute(
+            delete(DBIndicatorData).where(DBIndicatorData.indicator_code.not_in(listed))
+        ).rowcount
+        nindicators = self._session.execute(
+            delete(DBIndicatorState).where(DBIndicatorState.code.not_in(listed))
+        ).rowcount
+        self._session.commit()
+        if nindicators or nrows:
+            logger.info(
+                f"Removed {nindicators} indicators that are no longer listed "
+                f"and their {nrows} rows"
+            )
+
+    def _load_indicator_states(self):
+        self._indicator_states = {
+            row.code: {
+                "indicator_name": row.indicator_name,
+                "indicator_url": row.indicator_url,
+                "etag": row.etag,
+                "last_modified": row.last_modified,
+                "digest": row.digest,
+            }
+            for row in self._session.query(DBIndicatorState).all()
+        }
+        self._refresh_summary = {"refreshed": 0, "skipped": 0}
+
+    def _store_indicator(self, indicator, indicator_json, stats=None):
+        """Write an indicator's rows to the database. In incremental mode,
+        unchanged indicators are skipped and the rows of changed indicators
+        replace the old ones, with the new validators stored alongside in
+        the same transaction.
+
+        Returns:
+            int: Number of rows written
+        """
+        if not self._incremental:
+            return self._write_indicator_data(
+                indicator, self._indicator_batches(indicator, indicator_json), stats
+            )
+        indicator_code, indicator_name, indicator_url = indicator
+        state = self._indicator_states.get(indicator_code)
+        self._session.merge(
+            DBIndicatorState(
+                code=indicator_code,
+                indicator_name=indicator_name,
+                indicator_url=indicator_url,
+                etag=indicator_json.etag,
+                last_modified=indicator_json.last_modified,
+                digest=indicator_json.digest,
+            )
+        )
+        if indicator_json.changed:
+            self._session.execute(
+                delete(DBIndicatorData).where(
+                    DBIndicatorData.indicator_code == indicator_code
                 )
-                .filter(DBCategories.title == category_name)
-                .filter(DBIndicatorData.country_code == country_iso3)
-                .filter(DBIndicators.to_archive.is_(false()))
-                .first()
             )
-            if data_exists:
-                country_category_names.append(category_name)
-        for category_name in country_category_names:
-            parts = re.split(r"\s+and\s+", category_name, flags=re.IGNORECASE)
-            for part in parts:
-                cleaned = _clean_tag(part)
-                if cleaned:
-                    tags.append(cleaned)
-
-        tags = list(OrderedDict.fromkeys(tags).keys())
-        tags, _ = Vocabulary.get_mapped_tags(tags)
-        tags = base_tags + tags
-        return tags
+            self._refresh_summary["refreshed"] += 1
+            return self._write_indicator_data(
+                indicator, self._indicator_batches(indicator, indicator_json), stats
+            )
+        logger.info(f"Indicator {indicator_name} is unchanged, skipping")
+        if (state["indicator_name"], state["indicator_url"]) != (
+            indicator_name,
+            indicator_url,
+        ):
+            self._session.execute(
+                update(DBIndicatorData)
+                .where(DBIndicatorData.indicator_code == indicator_code)
+                .values(indicator_name=indicator_name, indicator_url=indicator_url)
+            )
+        self._session.commit()
+        self._refresh_summary["skipped"] += 1
+        return 0
 
-    def _populate_indicator_data_db(self, create_archived_datasets: bool):
-        for db_row in self._session.query(DBIndicators).all():
-            indicator_name = db_row.title
-            indicator_url = db_row.url
-            indicator_code = db_row.code
-            to_archive = db_row.to_archive
+    def get_refresh_summary(self):
+        """Public method that returns how many indicators were refreshed and
+        how many were skipped as unchanged in incremental mode"""
+        return self._refresh_summary
 
+    def _indicators_to_download(self, create_archived_datasets: bool):
+        indicators = []
+        for db_row in self._session.query(DBIndicators).all():
             # If we're not creating the archived datasets,
             # save time by not downloading and populating
             # the outdated indicators (there are thousands)
-            if to_archive and not create_archived_datasets:
+            if db_row.to_archive and not create_archived_datasets:
                 continue
+            indicators.append((db_row.code, db_row.title, db_row.url))
+        return indicators
 
-            logger.info(f"Downloading file for indicator {indicator_name}")
-            base_url = self._configuration["base_url"]
-            url = f"{base_url}api/{indicator_code}"
-            try:
-                indicator_json = self._retriever.download_json(url)
-            except (DownloadError, FileNotFoundError):
-                logger.warning(f"{url} has no data")
+    def _populate_indicator_data_db(self, create_archived_datasets: bool):
+        indicators = self._indicators_to_download(create_archived_datasets)
+        for indicator, indicator_json in self._download_in_order(
+            self._download_indicator, indicators
+        ):
+            if indicator_json is None:
                 continue
-            logger.info(f"Populating DB for indicator {indicator_name}")
-
-            batch = []
-            irow = 0
-            for row in indicator_json["value"]:
-                if row["SpatialDimType"] != "COUNTRY":
-                    continue
-                country_iso3 = row["SpatialDim"]
-                country_name = self._countries_dict[country_iso3]
-                startyear = datetime.fromisoformat(row["TimeDimensionBegin"]).strftime(
-                    "%Y"
-                )
-                endyear = datetime.fromisoformat(row["TimeDimensionEnd"]).strftime("%Y")
-                db_indicators_row = dict(
-                    id=row["Id"],
-                    indicator_code=indicator_code,
-                    indicator_name=indicator_name,
-                    indicator_url=indicator_url,
-                    year=row["TimeDim"],
-                    start_year=startyear,
-                    end_year=endyear,
-                    region_code=row["ParentLocationCode"],
-                    region_display=row["ParentLocation"],
-                    country_code=country_iso3,
-                    country_display=country_name,
-                    dimension_type=row["Dim1Type"],
-                    dimension_code=row["Dim1"],
-                    dimension_name=self._dimension_value_names_dict.get(row["Dim1"]),
-                    numeric=row["NumericValue"],
-                    value=row["Value"],
-                    low=row["Low"],
-                    high=row["High"],
-                )
-                batch.append(db_indicators_row)
-                irow += 1
-
-                if len(batch) >= _BATCH_SIZE:
-                    logger.info(f"Added {irow} rows")
-                    stmt = sqlite_insert(DBIndicatorData).values(batch)
-                    stmt = stmt.on_conflict_do_update(
-                        index_elements=["id"],
-                        set_={
-                            "indicator_code": stmt.excluded.indicator_code,
-                            "indicator_name": stmt.excluded.indicator_name,
-                            "indicator_url": stmt.excluded.indicator_url,
-                            "year": stmt.excluded.year,
-                            "start_year": stmt.excluded.start_year,
-                            "end_year": stmt.excluded.end_year,
-                            "region_code": stmt.excluded.region_code,
-                            "region_display": stmt.excluded.region_display,
-                            "country_code": stmt.excluded.country_code,
-                            "country_display": stmt.excluded.country_display,
-                            "dimension_type": stmt.excluded.dimension_type,
-                            "dimension_code": stmt.excluded.dimension_code,
-                            "dimension_name": stmt.excluded.dimension_name,
-                            "numeric": stmt.excluded.numeric,
-                            "value": stmt.excluded.value,
-                            "low": stmt.excluded.low,
-                            "high": stmt.excluded.high,
-                        },
-                    )
-                    self._session.execute(stmt)
-                    batch = []
-
-            if batch:
-                stmt = sqlite_insert(DBIndicatorData).values(batch)
-                stmt = stmt.on_conflict_do_update(
-                    index_elements=["id"],
-                    set_={
-                        "indicator_code": stmt.excluded.indicator_code,
-                        "indicator_name": stmt.excluded.indicator_name,
-                        "indicator_url": stmt.excluded.indicator_url,
-                        "year": stmt.excluded.year,
-                        "start_year": stmt.excluded.start_year,
-                        "end_year": stmt.excluded.end_year,
-                        "region_code": stmt.excluded.region_code,
-                        "region_display": stmt.excluded.region_display,
-                        "country_code": stmt.excluded.country_code,
-                        "country_display": stmt.excluded.country_display,
-                        "dimension_type": stmt.excluded.dimension_type,
-                        "dimension_code": stmt.excluded.dimension_code,
-                        "dimension_name": stmt.excluded.dimension_name,
-                        "numeric": stmt.excluded.numeric,
-                        "value": stmt.excluded.value,
-                        "low": stmt.excluded.low,
-                        "high": stmt.excluded.high,
-                    },
-                )
-                self._session.execute(stmt)
+            self._store_indicator(indicator, indicator_json)
 
+    def _populate_indicator_data_db_async(self, create_archived_datasets: bool):
+        """Populate the indicator data using the asyncio ingest engine so
+        that downloading overlaps with parsing and inserting"""
+        indicators = self._indicators_to_download(create_archived_datasets)
+        pool = RetrieverPool(
+            self._retriever,
+            self._download_workers,
+            self._configuration.get("rate_limit"),
+        )
+
+        def fetch(indicator):
+            return self._download_indicator(pool.get_retriever(), indicator)
+
+        try:
+            AsyncIngest(
+                fetch, self._store_indicator, fetchers=self._download_workers
+            ).run(indicators)
+        finally:
+            pool.close()
+
+    def _indicator_batches(self, indicator, indicator_json):
+        """Yield the country rows of an indicator as column batches of up to
+        _BATCH_SIZE rows"""
+        rows = (
+            row
+            for row in self._indicator_values(indicator_json)
+            if row["SpatialDimType"] == "COUNTRY"
+        )
+        while True:
+            chunk = list(islice(rows, _BATCH_SIZE))
+            if not chunk:
+                return
+            yield self._transform_batch(indicator, chunk)
+
+    def _transform_batch(self, indicator, rows):
+        """Map a list of API rows to a dictionary of indicator_data columns.
+        The fields of every row are extracted in one pass and transposed into
+        columns, then years and country and dimension names are looked up a
+        column at a time."""
+        indicator_code, indicator_name, indicator_url = indicator
+        (
+            ids,
+            years,
+            begins,
+            ends,
+            region_codes,
+            region_displays,
+            country_codes,
+            dimension_types,
+            dimension_codes,
+            numerics,
+            values,
+            lows,
+            highs,
+        ) = zip(*map(_API_ROW_FIELDS, rows))
+        nrows = len(ids)
+        return {
+            "id": ids,
+            "indicator_code": (indicator_code,) * nrows,
+            "indicator_name": (indicator_name,) * nrows,
+            "indicator_url": (indicator_url,) * nrows,
+            "year": years,
+            "start_year": tuple(map(_year_from_timestamp, begins)),
+            "end_year": tuple(map(_year_from_timestamp, ends)),
+            "region_code": region_codes,
+            "region_display": region_displays,
+            "country_code": country_codes,
+            "country_display": tuple(
+                map(self._countries_dict.__getitem__, country_codes)
+            ),
+            "dimension_type": dimension_types,
+            "dimension_code": dimension_codes,
+            "dimension_name": tuple(
+                map(self._dimension_value_names_dict.get, dimension_codes)
+            ),
+            "numeric": numerics,
+            "value": values,
+            "low": lows,
+            "high": highs,
+        }
+
+    def _write_indicator_data(self, indicator, batches, stats=None):
+        """Upsert the column batches of one indicator and commit. If stats
+        is given, the time spent writing to the database is added to it.
+
+        Returns:
+            int: Number of rows written
+        """
+        indicator_name = indicator[1]
+        logger.info(f"Populating DB for indicator {indicator_name}")
+        irow = 0
+        for batch in batches:
+            irow += len(batch["id"])
+            with stats.time() if stats else nullcontext():
+                self._upsert_indicator_data(batch)
+            logger.info(f"Added {irow} rows")
+
+        with stats.time() if stats else nullcontext():
             self._session.commit()
-            logger.info(f"Done indicator {indicator_name}")
+        self._metrics.add("db_rows_written", irow, table="indicator_data")
+        logger.info(f"Done indicator {indicator_name}")
+        return irow
+
+    @contextmanager
+    def _bulk_load(self):
+        """Apply the _BULK_LOAD_PRAGMAS while loading a fresh database,
+        reverting them afterwards. The PRAGMAs are set on the current
+        connection and on any connection opened during the load since the
+        session gets a new connection after each commit."""
+        self._session.commit()
+        engine = self._session.get_bind()
+        if engine.dialect.name != "sqlite":
+            yield
+            return
+        connection = self._session.connection()
+        previous = {
+            name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in _BULK_LOAD_PRAGMAS
+        }
 
-    @staticmethod
-    def get_showcase(retriever, country_iso3, country_name, slugified_name, alltags):
+        def apply_pragmas(dbapi_connection, _):
+            for name, value in _BULK_LOAD_PRAGMAS.items():
+                dbapi_connection.execute(f"PRAGMA {name} = {value}")
+
+        apply_pragmas(connection.connection.dbapi_connection, None)
+        event.listen(engine, "connect", apply_pragmas)
         try:
-            lower_iso3 = country_iso3.lower()
-            url = f"https://www.who.int/countries/{lower_iso3}/en/"
-            retriever.download_file(url)
-            showcase = Showcase(
-                {
-                    "name": f"{slugified_name}-showcase",
-                    "title": f"Indicators for {country_name}",
-                    "notes": f"Health indicators for {country_name}",
-                    "url": url,
-                    "image_url": f"https://cdn.who.int/media/images/default-source/countries-overview/flags/{lower_iso3}.jpg",
-                }
+            yield
+        finally:
+            event.remove(engine, "connect", apply_pragmas)
+            self._session.commit()
+            connection = self._session.connection()
+            for name, value in previous.items():
+                connection.exec_driver_sql(f"PRAGMA {name} = {value}")
+            self._session.commit()
+
+    def _create_indexes(self):
+        """Build the _SECONDARY_INDEXES if they do not exist yet and update
+        the query planner statistics for the export queries"""
+        connection = self._session.connection()
+        start = perf_counter()
+        for table, column in _SECONDARY_INDEXES:
+            connection.exec_driver_sql(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"
             )
-            showcase.add_tags(alltags)
-            return showcase
-        except DownloadError:
+        self._session.commit()
+        logger.info(f"Built indexes in {perf_counter() - start:.1f}s")
+        start = perf_counter()
+        self._session.connection().exec_driver_sql("ANALYZE")
+        self._session.commit()
+        logger.info(f"Analyzed database in {perf_counter() - start:.1f}s")
+
+    def _upsert_indicator_data(self, batch):
+        """Upsert a column batch with one prepared statement executed for
+        every row. Building a multi-row insert instead means SQLAlchemy
+        compiles a new statement with a bound variable for every value of
+        the batch, which dominates the load time. With the Parquet store,
+        the batch is appended to it instead."""
+        if self._parquet_store:
+            self._parquet_store.write(batch)
+            return
+        self._session.connection().exec_driver_sql(
+            _UPSERT_SQL,
+            list(zip(*(batch[column] for column in _INDICATOR_DATA_COLUMNS))),
+        )
+
+    def export_country_files(self, create_archived_datasets: bool):
+        """Write the CSV files of all countries in one pass over the
+        indicator data. The datasets generated afterwards use these files
+        instead of querying the data of each country.
+
+        Args:
+            create_archived_datasets (bool): also write the archived indicators files
+
+        Returns:
+            None
+        """
+        with self._metrics.time("stage", stage="export"):
+            self._exported_files = self._export(
+                self._indicator_categories,
+                self._get_archived_indicators() if create_archived_datasets else set(),
+            )
+
+    def _export(self, indicator_categories, archived_indicators, country_iso3=None):
+        exported = ExportEngine(
+            self._session,
+            self._tempdir,
+            self._hxltags,
+            indicator_categories,
+            archived_indicators,
+            self._parquet_store,
+        ).run(country_iso3)
+        self._metrics.add(
+            "csv_bytes",
+            sum(file.bytes for files in exported.values() for file in files.values()),
+        )
+        return exported
+
+    def _get_archived_indicators(self):
+        return {
+            row.code
+            for row in self._session.query(DBIndicators.code).filter(
+                DBIndicators.to_archive.is_(true())
+            )
+        }
+
+    def _get_country_files(self, country_iso3, archived):
+        """Files of a country written by export_country_files, or if it has
+        not been run, the files written now with one query for the country's
+        data, each row going to all of the files it belongs to"""
+        if self._exported_files is not None:
+            return self._exported_files.get(country_iso3, dict())
+        if archived:
+            exported = self._export(
+                dict(), self._get_archived_indicators(), country_iso3
+            )
+        else:
+            exported = self._export(self._indicator_categories, set(), country_iso3)
+        return exported.get(country_iso3, dict())
+
+    def _generate_resource(
+        self, dataset, files, filename, resourcedata, set_time_period
+    ):
+        """Add the resource for the written file filename to the dataset,
+        setting the dataset time period from its years if set_time_period is
+        True
+
+        Returns:
+            bool: True if the resource was added
+        """
+        exported_file = files.get(filename)
+        if exported_file is None:
+            logger.error(f"No data rows in {filename}!")
+            return False
+        if set_time_period:
+            if exported_file.start_year is None:
+                logger.error(f"No dates in {filename}!")
+                return False
+            startdate, _ = parse_date_range(
+                str(exported_file.start_year), date_format="%Y"
+            )
+            _, enddate = parse_date_range(str(exported_file.end_year), date_format="%Y")
+            dataset.set_time_period(startdate, enddate)
+        resource = Resource(resourcedata)
+        resource.set_format("csv")
+        resource.set_file_to_upload(exported_file.path)
+        dataset.add_update_resource(resource)
+        return True
+
+    @staticmethod
+    def get_showcase_url(country_iso3):
+        return f"https://www.who.int/countries/{country_iso3.lower()}/en/"
+
+    def probe_showcase_urls(self, countries):
+        """Public method that checks up front and concurrently whether the
+        showcase pages of the given countries exist, if there is a URL probe,
+        so that generating each showcase does not wait on a request"""
+        if self._url_probe is None:
+            return
+        self._url_probe.probe(
+            self.get_showcase_url(country["Code"]) for country in countries
+        )
+
+    @staticmethod
+    def get_showcase(
+        retriever,
+        country_iso3,
+        country_name,
+        slugified_name,
+        alltags,
+        url_exists=None,
+    ):
+        lower_iso3 = country_iso3.lower()
+        url = Pipeline.get_showcase_url(country_iso3)
+        if url_exists is None:
+            try:
+                retriever.download_file(url)
+                exists = True
+            except DownloadError:
+                exists = False
+        else:
+            exists = url_exists(url)
+        if not exists:
             # If the showcase URL doesn't exist, only return the showcase id
             # so that it can be deleted if needed
             return Showcase({"name": f"{slugified_name}-showcase"})
+        showcase = Showcase(
+            {
+                "name": f"{slugified_name}-showcase",
+                "title": f"Indicators for {country_name}",
+                "notes": f"Health indicators for {country_name}",
+                "url": url,
+                "image_url": f"https://cdn.who.int/media/images/default-source/countries-overview/flags/{lower_iso3}.jpg",
+            }
+        )
+        showcase.add_tags(alltags)
+        return showcase
 
     def generate_dataset_and_showcase(self, country):
         # Setup the dataset information
         country_iso3 = country["Code"]
         country_name = self._countries_dict[country_iso3]
         title = f"{country_name} - Health Indicators"
+        if country_iso3 not in self._coverage:
+            logger.error(f"{country_name} has no data!")
+            return None, None
 
         logger.info(f"Creating dataset: {title}")
         slugified_name = slugify(f"WHO data for {country_iso3}").lower()
 
-        # Get unique category names
-        category_names = [
-            row.title
-            for row in self._session.query(DBCategories.title).distinct().all()
-        ]
-        cat_str = ", ".join(category_names)
+        category_names = self._metadata.category_names
+        cat_str = self._metadata.categories_str
         dataset = Dataset(
             {
                 "name": slugified_name,
@@ -422,94 +931,40 @@ class Pipeline:
         tags = self._create_tags(country_iso3=country_iso3, to_archive=False)
         dataset.add_tags(tags)
 
+        # Write the files of all categories with one query
+        files = self._get_country_files(country_iso3, archived=False)
+
         # Loop through categories and generate resource for each
+        covered_category_names = self._coverage.get(country_iso3, set())
         for category_name in category_names:
             logger.info(f"Category: {category_name}")
+            if category_name not in covered_category_names:
+                logger.info(f"No data for category {category_name}, skipping")
+                continue
 
-            all_rows_for_category = (
-                self._session.query(DBIndicatorData)
-                .join(
-                    DBIndicators,
-                    DBIndicators.code == DBIndicatorData.indicator_code,
-                )
-                .join(
-                    DBCategories,
-                    DBCategories.indicator_code == DBIndicators.code,
-                )
-                .filter(DBCategories.title == category_name)
-                .filter(DBIndicatorData.country_code == country_iso3)
-                # Create the archived dataset later
-                .filter(DBIndicators.to_archive.is_(false()))
-                .all()
-            )
-
-            category_data = [_parse_indicator_row(row) for row in all_rows_for_category]
-            indicator_links = [
-                f"[{row.title}]({row.url})"
-                for row in (
-                    self._session.query(DBIndicators)
-                    .join(
-                        DBCategories,
-                        DBCategories.indicator_code == DBIndicators.code,
-                    )
-                    .filter(DBCategories.title == category_name)
-                )
-            ]
-
-            category_link = f"*{category_name}:*\n{', '.join(indicator_links)}"
-            slugified_category = slugify(category_name, separator="_")
-            filename = f"{slugified_category}_indicators_{country_iso3.lower()}.csv"
+            filename = category_filename(category_name, country_iso3)
             resourcedata = {
                 "name": f"{category_name} Indicators for {country_name}",
-                "description": category_link,
+                "description": self._metadata.category_descriptions[category_name],
             }
 
-            success, results = dataset.generate_resource_from_iterable(
-                list(self._hxltags.keys()),
-                category_data,
-                self._hxltags,
-                self._tempdir,
-                filename,
-                resourcedata,
-                date_function=None,
-                quickcharts=None,
+            success = self._generate_resource(
+                dataset, files, filename, resourcedata, False
             )
 
             if not success:
-                logger.error(f"Resource for category {category_name} failed:{results}")
+                logger.error(f"Resource for category {category_name} failed")
 
         # Create the dataset with all indicators
 
-        filename = f"health_indicators_{country_iso3.lower()}.csv"
+        filename = all_indicators_filename(country_iso3)
         resourcedata = {
             "name": f"All Health Indicators for {country_name}",
             "description": "See resource descriptions below for links "
             "to indicator metadata",
         }
-        all_rows = (
-            self._session.query(DBIndicatorData)
-            .join(
-                DBIndicators,
-                DBIndicatorData.indicator_code == DBIndicators.code,
-            )
-            .filter(DBIndicatorData.country_code == country_iso3)
-            .filter(DBIndicators.to_archive.is_(false()))
-            .all()
-        )
-
-        all_indicators_data = [_parse_indicator_row(row) for row in all_rows]
-
-        success_all_indicators, results_all_indicators = (
-            dataset.generate_resource_from_iterable(
-                list(self._hxltags.keys()),
-                all_indicators_data,
-                self._hxltags,
-                self._tempdir,
-                filename,
-                resourcedata,
-                date_function=_yearcol_function,
-                quickcharts=None,
-            )
+        success_all_indicators = self._generate_resource(
+            dataset, files, filename, resourcedata, True
         )
 
         if not success_all_indicators:
@@ -527,6 +982,7 @@ class Pipeline:
             country_name,
             slugified_name,
             tags,
+            self._url_probe.exists if self._url_probe else None,
         )
         return dataset, showcase
 
@@ -560,34 +1016,15 @@ class Pipeline:
 
         # Create the dataset with all indicators
 
-        filename = f"historical_health_indicators_{country_iso3.lower()}.csv"
+        filename = archived_indicators_filename(country_iso3)
         resourcedata = {
             "name": f"All Historical Health Indicators for {country_name}",
             "description": "Historical health indicators no longer updated by WHO",
         }
 
-        all_rows = (
-            self._session.query(DBIndicatorData)
-            .join(
-                DBIndicators,
-                DBIndicatorData.indicator_code == DBIndicators.code,
-            )
-            .filter(DBIndicatorData.country_code == country_iso3)
-            .filter(DBIndicators.to_archive.is_(true()))
-            .all()
-        )
-        all_indicators_data = [_parse_indicator_row(row) for row in all_rows]
-
-        success_all_indicators, results_all_indicators = (
-            dataset.generate_resource_from_iterable(
-                list(self._hxltags.keys()),
-                all_indicators_data,
-                self._hxltags,
-                self._tempdir,
-                filename,
-                resourcedata,
-                date_function=_yearcol_function,
-            )
+        files = self._get_country_files(country_iso3, archived=True)
+        success_all_indicators = self._generate_resource(
+            dataset, files, filename, resourcedata, True
         )
 
         if not success_all_indicators:
@@ -595,35 +1032,3 @@ class Pipeline:
             return None
 
         return dataset
-
-
-def _parse_indicator_row(row):
-    return {
-        "GHO (CODE)": row.indicator_code,
-        "GHO (DISPLAY)": row.indicator_name,
-        "GHO (URL)": row.indicator_url,
-        "YEAR (DISPLAY)": row.year,
-        "STARTYEAR": row.start_year,
-        "ENDYEAR": row.end_year,
-        "REGION (CODE)": row.region_code,
-        "REGION (DISPLAY)": row.region_display,
-        "COUNTRY (CODE)": row.country_code,
-        "COUNTRY (DISPLAY)": row.country_display,
-        "DIMENSION (TYPE)": row.dimension_type,
-        "DIMENSION (CODE)": row.dimension_code,
-        "DIMENSION (NAME)": row.dimension_name,
-        "Numeric": row.numeric,
-        "Value": row.value,
-        "Low": row.low,
-        "High": row.high,
-    }
-
-
-def _yearcol_function(row):
-    result = dict()
-    year = row["YEAR (DISPLAY)"]
-    if year:
-        result["startdate"], result["enddate"] = parse_date_range(
-            str(year), date_format="%Y"
-        )
-    return result
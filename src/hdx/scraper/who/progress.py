@@ -0,0 +1,75 @@
+"""Progress storing for countries that finish out of order"""
+
+import threading
+from collections import OrderedDict
+from os.path import join
+from typing import Dict, Hashable
+
+from hdx.utilities.saver import save_text
+
+
+class ProgressTracker:
+    """Stores progress in the progress file used by progress_storing_folder
+    when countries are processed concurrently and can finish out of order.
+    The file always holds the first country that has not finished, so a
+    resumed run restarts from there, processing again any later countries
+    that had already finished. That is harmless as uploads update existing
+    datasets. Countries can be finished from any thread.
+
+    Args:
+        info (Dict): Dictionary from wheretostart_tempdir_batch
+        key (str): Key of the country code in each country. Defaults to "Code".
+    """
+
+    def __init__(self, info: Dict, key: str = "Code"):
+        self._info = info
+        self._key = key
+        self._progress_file = join(info["folder"], "progress.txt")
+        self._pending = OrderedDict()
+        self._last = None
+        self._lock = threading.Lock()
+
+    def start(self, code: Hashable) -> None:
+        """Record that a country has started
+
+        Args:
+            code (Hashable): Country code
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._pending[code] = False
+            self._last = code
+
+    def finish(self, code: Hashable) -> None:
+        """Record that a country has finished successfully
+
+        Args:
+            code (Hashable): Country code
+
+        Returns:
+            None
+        """
+        with self._lock:
+            if code in self._pending:
+                self._pending[code] = True
+
+    def store(self) -> None:
+        """Write the first country that has not finished, or the last country
+        started if all have finished, to the progress file
+
+        Returns:
+            None
+        """
+        with self._lock:
+            # Drop finished countries from the front so that the first
+            # pending country is the first that has not finished
+            while self._pending and next(iter(self._pending.values())):
+                self._pending.popitem(last=False)
+            current = next(iter(self._pending)) if self._pending else self._last
+            if current is None:
+                return
+            output = f"{self._key}={current}"
+            self._info["progress"] = output
+            save_text(output, self._progress_file)
@@ -0,0 +1,114 @@
+"""Thread pool of retrievers sharing one HTTP session and rate limit"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from hdx.utilities.downloader import Download
+from hdx.utilities.retriever import Retrieve
+from ratelimit import RateLimitDecorator, sleep_and_retry
+
+logger = logging.getLogger(__name__)
+
+
+class RetrieverPool:
+    """Runs downloads in a bounded pool of worker threads. A Download object
+    keeps the current response on itself so it cannot be shared between
+    threads. Each worker thread therefore gets its own clone of the main
+    retriever, backed by the main downloader's session. All clones go through
+    one rate limiter so that together they stay within the rate_limit budget.
+
+    Args:
+        retriever (Retrieve): Retriever to clone for each worker
+        workers (int): Number of worker threads
+        rate_limit (Optional[Dict]): Rate limit shared by all workers eg. {"calls": 1, "period": 1}. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        retriever: Retrieve,
+        workers: int,
+        rate_limit: Optional[Dict] = None,
+    ):
+        self._retriever = retriever
+        self._workers = workers
+        if rate_limit:
+            self._limiter = RateLimitDecorator(
+                calls=rate_limit["calls"], period=rate_limit["period"]
+            )
+        else:
+            self._limiter = None
+        self._local = threading.local()
+        self._downloaders = []
+        self._lock = threading.Lock()
+
+    def get_retriever(self) -> Retrieve:
+        """Get the retriever for the calling worker thread, creating it on
+        first use
+
+        Returns:
+            Retrieve: Retriever for this thread
+        """
+        retriever = getattr(self._local, "retriever", None)
+        if retriever is None:
+            downloader = Download(session=self._retriever.downloader.session)
+            if self._limiter:
+                downloader.setup = sleep_and_retry(
+                    self._limiter(downloader.normal_setup)
+                )
+            with self._lock:
+                self._downloaders.append(downloader)
+            retriever = self._retriever.clone(downloader)
+            self._local.retriever = retriever
+        return retriever
+
+    def map(
+        self,
+        function: Callable[[Retrieve, Any], Any],
+        items: Iterable[Any],
+    ) -> Iterator[Tuple[Any, Any]]:
+        """Call function(retriever, item) for each item in the worker threads,
+        yielding (item, result) in the same order as items. At most twice
+        the number of workers are in flight at once so that results do not
+        pile up in memory if the consumer is slower than the downloads.
+
+        Args:
+            function (Callable[[Retrieve, Any], Any]): Function to call
+            items (Iterable[Any]): Items to pass to function
+
+        Returns:
+            Iterator[Tuple[Any, Any]]: (item, result) in order of items
+        """
+        items = iter(items)
+        max_in_flight = self._workers * 2
+
+        def call(item):
+            return function(self.get_retriever(), item)
+
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="download"
+        ) as executor:
+            in_flight = []
+            for item in items:
+                in_flight.append((item, executor.submit(call, item)))
+                if len(in_flight) >= max_in_flight:
+                    break
+            while in_flight:
+                item, future = in_flight.pop(0)
+                result = future.result()
+                for next_item in items:
+                    in_flight.append((next_item, executor.submit(call, next_item)))
+                    break
+                yield item, result
+
+    def close(self) -> None:
+        """Close the responses of the worker downloaders. The shared session
+        belongs to the main downloader and is left open.
+
+        Returns:
+            None
+        """
+        for downloader in self._downloaders:
+            downloader.close_response()
+        self._downloaders = []
@@ -0,0 +1,222 @@
+"""Deferred retries of countries that failed with a transient error"""
+
+import heapq
+import logging
+import threading
+from itertools import count
+from os.path import join
+from time import monotonic, sleep
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+
+from hdx.data.hdxobject import HDXError
+from hdx.utilities.base_downloader import DownloadError
+from hdx.utilities.saver import save_json, save_text
+from tenacity import RetryCallState, wait_random_exponential
+from tenacity.wait import wait_base
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredCall:
+    """A call that failed and is waiting to be retried"""
+
+    def __init__(self, key: Hashable, function: Callable, args: Tuple):
+        self.key = key
+        self.function = function
+        self.args = args
+        self.attempts = 0
+        self.error = None
+        self.order = None
+
+
+class DeferredRetries:
+    """Retries calls that failed with a transient error after the main loop
+    instead of sleeping in it, so that one failing country does not hold up
+    all the others. Failed calls are retried with the wait strategy (by
+    default exponential backoff with full jitter) until they succeed, run
+    out of attempts or the time budget for the retries runs out. Countries
+    whose calls are deferred count as handled for the progress file while
+    the countries are processed. If any of them still fails, drain moves
+    the progress file back to the first failed country so that a resumed
+    run starts from there. Calls can be deferred from any thread.
+
+    Args:
+        exceptions (Tuple[Type[Exception], ...]): Exceptions to retry. Defaults to (DownloadError, HDXError).
+        attempts (int): Maximum number of attempts including the first. Defaults to 5.
+        wait (Optional[wait_base]): tenacity wait strategy giving the delay before each retry. Defaults to random exponential waits of up to an hour starting from a minute.
+        time_budget (float): Seconds that draining the retries can take. Defaults to 4 hours.
+    """
+
+    def __init__(
+        self,
+        exceptions: Tuple[Type[Exception], ...] = (DownloadError, HDXError),
+        attempts: int = 5,
+        wait: Optional[wait_base] = None,
+        time_budget: float = 4 * 3600,
+    ):
+        self.exceptions = exceptions
+        self._attempts = attempts
+        if wait is None:
+            wait = wait_random_exponential(multiplier=60, max=3600)
+        self._wait = wait
+        self._time_budget = time_budget
+        self._pending = []
+        self._sequence = count()
+        self._lock = threading.Lock()
+        self.recovered: List[DeferredCall] = []
+        self.failed: List[DeferredCall] = []
+
+    def call(self, key: Hashable, function: Callable, *args: Any) -> Any:
+        """Call function(*args), deferring a retry of the same call if it
+        raises one of the exceptions to retry
+
+        Args:
+            key (Hashable): Key identifying the call eg. the country code
+            function (Callable): Function to call
+            *args (Any): Arguments to pass to function
+
+        Returns:
+            Any: What function returned or None if the call was deferred
+        """
+        try:
+            return function(*args)
+        except self.exceptions as ex:
+            self.defer(key, ex, function, *args)
+            return None
+
+    def defer(
+        self, key: Hashable, error: Exception, function: Callable, *args: Any
+    ) -> None:
+        """Defer a retry of function(*args) after it failed with error
+
+        Args:
+            key (Hashable): Key identifying the call eg. the country code
+            error (Exception): Error the call failed with
+            function (Callable): Function to retry
+            *args (Any): Arguments to pass to function
+
+        Returns:
+            None
+        """
+        deferred = DeferredCall(key, function, args)
+        with self._lock:
+            deferred.order = next(self._sequence)
+            self._schedule(deferred, error)
+
+    def _schedule(self, deferred: DeferredCall, error: Exception) -> None:
+        deferred.attempts += 1
+        deferred.error = error
+        if deferred.attempts >= self._attempts:
+            logger.error(
+                f"{deferred.key} failed after {deferred.attempts} attempts: {error}"
+            )
+            self.failed.append(deferred)
+            return
+        retry_state = RetryCallState(None, None, (), {})
+        retry_state.attempt_number = deferred.attempts
+        delay = self._wait(retry_state)
+        logger.warning(
+            f"{deferred.key} failed (attempt {deferred.attempts}), "
+            f"retrying in {delay:.0f}s: {error}"
+        )
+        heapq.heappush(
+            self._pending, (monotonic() + delay, next(self._sequence), deferred)
+        )
+
+    def drain(
+        self,
+        summary_path: Optional[str] = None,
+        info: Optional[Dict] = None,
+        countries: Optional[Iterable[Dict]] = None,
+        key: str = "Code",
+    ) -> None:
+        """Retry the deferred calls in the calling thread until they have all
+        succeeded or failed, or the time budget runs out. Calls that have not
+        succeeded by then have failed. Exceptions that are not retried are
+        raised straight away. A summary of the recovered and failed calls is
+        saved to summary_path if given. If any call failed, the progress file
+        is set to the first failed country if info is given and the error of
+        the first call to fail is then raised.
+
+        Args:
+            summary_path (Optional[str]): Path to save a JSON summary to. Defaults to None.
+            info (Optional[Dict]): Dictionary from wheretostart_tempdir_batch. Defaults to None.
+            countries (Optional[Iterable[Dict]]): Countries in the order they were processed. Defaults to None (the order calls were deferred in).
+            key (str): Key of the country code in each country. Defaults to "Code".
+
+        Returns:
+            None
+        """
+        deadline = monotonic() + self._time_budget
+        while self._pending:
+            due, _, deferred = heapq.heappop(self._pending)
+            if due > deadline:
+                logger.error(f"No time left to retry {deferred.key}")
+                self.failed.append(deferred)
+                continue
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+            try:
+                deferred.function(*deferred.args)
+            except self.exceptions as ex:
+                self._schedule(deferred, ex)
+                continue
+            logger.info(f"{deferred.key} succeeded on attempt {deferred.attempts + 1}")
+            self.recovered.append(deferred)
+        if summary_path:
+            save_json(self.get_summary(), summary_path)
+        if self.failed:
+            if info is not None:
+                self._store_progress(info, countries, key)
+            raise self.failed[0].error
+
+    def _store_progress(
+        self, info: Dict, countries: Optional[Iterable[Dict]], key: str
+    ) -> None:
+        """Point the progress file at the first failed country, since the
+        countries after it may have been processed but it was not"""
+        failed_keys = {deferred.key for deferred in self.failed}
+        first = None
+        if countries is not None:
+            first = next(
+                (country[key] for country in countries if country[key] in failed_keys),
+                None,
+            )
+        if first is None:
+            first = min(self.failed, key=lambda deferred: deferred.order).key
+        output = f"{key}={first}"
+        info["progress"] = output
+        save_text(output, join(info["folder"], "progress.txt"))
+        logger.info(f"Progress set to {output} so that a resumed run retries it")
+
+    def get_summary(self) -> Dict[str, List[Dict]]:
+        """Summary of the recovered and failed calls
+
+        Returns:
+            Dict[str, List[Dict]]: Keys, attempts and last errors by outcome
+        """
+        return {
+            "recovered": [
+                {"key": deferred.key, "attempts": deferred.attempts + 1}
+                for deferred in self.recovered
+            ],
+            "failed": [
+                {
+                    "key": deferred.key,
+                    "attempts": deferred.attempts,
+                    "error": f"{type(deferred.error).__name__}: {deferred.error}",
+                }
+                for deferred in self.failed
+            ],
+        }
@@ -0,0 +1,168 @@
+"""Generate and upload stages connected by a bounded queue"""
+
+import logging
+import queue
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from hdx.utilities.path import progress_storing_folder
+
+from .async_ingest import StageStats
+from .progress import ProgressTracker
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class UploadQueue:
+    """Generates the datasets of each country in the calling thread and hands
+    them to a pool of uploader threads through a bounded queue, so that local
+    dataset generation overlaps with the latency of HDX. When the queue is
+    full, generation waits, so at most queue_size + uploaders generated
+    countries are held at any time.
+
+    If generating or uploading raises an exception, no more countries are
+    generated, the queued countries are dropped, the uploads in progress are
+    finished and the exception is raised. Progress is stored with a
+    ProgressTracker, so the progress file always holds the first country
+    that has not been uploaded.
+
+    Args:
+        generate (Callable[[Dict], Any]): Blocking function returning what to upload for a country or None if there is nothing to upload
+        upload (Callable[[Any], None]): Blocking function uploading what generate returned
+        uploaders (int): Number of uploader threads. Defaults to 1.
+        queue_size (Optional[int]): Maximum number of generated countries waiting to be uploaded. Defaults to the number of uploaders.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[Dict], Any],
+        upload: Callable[[Any], None],
+        uploaders: int = 1,
+        queue_size: Optional[int] = None,
+    ):
+        self._generate = generate
+        self._upload = upload
+        self._uploaders = max(uploaders, 1)
+        self._queue_size = queue_size or self._uploaders
+        self._errors = []
+        self._lock = threading.Lock()
+        self.stats = {
+            "generate": StageStats("generate", "countries"),
+            "upload": StageStats("upload", "countries"),
+        }
+        # Time generation waited for room in the queue and the uploaders
+        # waited for generated countries, summed over the uploaders
+        self.queue_full_seconds = 0.0
+        self.queue_empty_seconds = 0.0
+
+    def run(
+        self,
+        info: Dict,
+        countries: Iterable[Dict],
+        key: str = "Code",
+    ) -> Dict[str, StageStats]:
+        """Generate and upload all countries, blocking until done
+
+        Args:
+            info (Dict): Dictionary from wheretostart_tempdir_batch
+            countries (Iterable[Dict]): Countries to generate and upload
+            key (str): Key of the country code in each country. Defaults to "Code".
+
+        Returns:
+            Dict[str, StageStats]: Statistics for the generate and upload stages
+        """
+        start = perf_counter()
+        progress = ProgressTracker(info, key)
+        uploads = queue.Queue(maxsize=self._queue_size)
+        threads = [
+            threading.Thread(
+                target=self._consume,
+                args=(uploads, progress),
+                name=f"upload_{i}",
+                daemon=True,
+            )
+            for i in range(self._uploaders)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            self._produce(info, countries, key, uploads, progress)
+        except BaseException:
+            self._drain(uploads)
+            raise
+        finally:
+            for _ in threads:
+                uploads.put(_DONE)
+            for thread in threads:
+                thread.join()
+            progress.store()
+        elapsed = perf_counter() - start
+        for stage in self.stats.values():
+            logger.info(str(stage))
+        logger.info(
+            f"Queue full wait: {self.queue_full_seconds:.1f}s, "
+            f"queue empty wait: {self.queue_empty_seconds:.1f}s"
+        )
+        uploaded = self.stats["upload"].rows
+        logger.info(
+            f"Generated and uploaded {uploaded} countries in {elapsed:.1f}s "
+            f"({uploaded / elapsed if elapsed else 0:.1f} countries/sec)"
+        )
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def _produce(self, info, countries, key, uploads, progress) -> None:
+        generate_stats = self.stats["generate"]
+        for _, country in progress_storing_folder(info, countries, key):
+            if self._errors:
+                return
+            code = country[key]
+            progress.start(code)
+            with generate_stats.time():
+                generated = self._generate(country)
+            generate_stats.rows += 1
+            if generated is None:
+                progress.finish(code)
+            else:
+                start = perf_counter()
+                uploads.put((code, generated))
+                self.queue_full_seconds += perf_counter() - start
+            progress.store()
+
+    def _consume(self, uploads: queue.Queue, progress: ProgressTracker) -> None:
+        upload_stats = self.stats["upload"]
+        while True:
+            start = perf_counter()
+            entry = uploads.get()
+            waited = perf_counter() - start
+            with self._lock:
+                self.queue_empty_seconds += waited
+            if entry is _DONE:
+                return
+            if self._errors:
+                # Drop what is queued once something has failed
+                continue
+            code, generated = entry
+            start = perf_counter()
+            try:
+                self._upload(generated)
+            except Exception as ex:
+                with self._lock:
+                    self._errors.append(ex)
+                continue
+            progress.finish(code)
+            with self._lock:
+                upload_stats.seconds += perf_counter() - start
+                upload_stats.rows += 1
+
+    @staticmethod
+    def _drain(uploads: queue.Queue) -> None:
+        try:
+            while True:
+                uploads.get_nowait()
+        except queue.Empty:
+            pass
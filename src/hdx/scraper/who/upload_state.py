@@ -0,0 +1,107 @@
+"""Content hashes of uploaded datasets, used to skip unchanged uploads"""
+
+import hashlib
+import json
+import logging
+import threading
+from os.path import exists
+from typing import Optional
+
+from hdx.data.dataset import Dataset
+from hdx.data.showcase import Showcase
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+
+logger = logging.getLogger(__name__)
+
+_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadState:
+    """Keeps a hash of each uploaded dataset in a local JSON file, so that a
+    dataset can be skipped if neither its metadata, its resources' metadata
+    and files, nor its showcase have changed since it was last uploaded. The
+    export writes rows in a stable order, so unchanged data gives the same
+    files. Only successful uploads are recorded and the file is saved after
+    each one, so a failed or interrupted run uploads what it did not finish
+    next time. Can be used from any thread.
+
+    Args:
+        path (str): Path of the JSON file holding the hashes
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        if exists(path):
+            self._hashes = load_json(path)
+        else:
+            self._hashes = dict()
+        self._lock = threading.Lock()
+        self.skipped = 0
+        self.uploaded = 0
+
+    @staticmethod
+    def get_hash(dataset: Dataset, showcase: Optional[Showcase] = None) -> str:
+        """Hash of a dataset's metadata, its resources' metadata and files
+        and optionally a showcase's metadata
+
+        Args:
+            dataset (Dataset): Dataset
+            showcase (Optional[Showcase]): Showcase. Defaults to None.
+
+        Returns:
+            str: Hex digest
+        """
+        sha256 = hashlib.sha256()
+        metadata = {
+            "dataset": dataset.data,
+            "resources": [resource.data for resource in dataset.get_resources()],
+            "showcase": showcase.data if showcase else None,
+        }
+        sha256.update(json.dumps(metadata, sort_keys=True, default=str).encode())
+        for resource in dataset.get_resources():
+            path = resource.get_file_to_upload()
+            if not path:
+                continue
+            with open(path, "rb") as file:
+                while block := file.read(_BLOCK_SIZE):
+                    sha256.update(block)
+        return sha256.hexdigest()
+
+    def is_unchanged(self, name: str, content_hash: str) -> bool:
+        """Whether a dataset was last uploaded with the given hash. Counts
+        the dataset as skipped if so.
+
+        Args:
+            name (str): Dataset name
+            content_hash (str): Hash from get_hash
+
+        Returns:
+            bool: True if unchanged
+        """
+        with self._lock:
+            unchanged = self._hashes.get(name) == content_hash
+            if unchanged:
+                self.skipped += 1
+            return unchanged
+
+    def record(self, name: str, content_hash: str) -> None:
+        """Record that a dataset was uploaded with the given hash and save
+        the hashes
+
+        Args:
+            name (str): Dataset name
+            content_hash (str): Hash from get_hash
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._hashes[name] = content_hash
+            self.uploaded += 1
+            save_json(self._hashes, self._path)
+
+    def log_summary(self) -> None:
+        logger.info(
+            f"Uploaded {self.uploaded} datasets, skipped {self.skipped} unchanged"
+        )
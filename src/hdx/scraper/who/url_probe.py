@@ -0,0 +1,136 @@
+"""Cached checks of whether web pages exist"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+from time import perf_counter, time
+from typing import Dict, Iterable
+
+from hdx.utilities.loader import load_json
+from hdx.utilities.saver import save_json
+from requests import RequestException, Session
+
+logger = logging.getLogger(__name__)
+
+
+class UrlProbe:
+    """Checks whether URLs exist with HEAD requests, falling back to a GET of
+    the first byte for servers that do not allow HEAD, instead of downloading
+    whole pages. Results are cached in a JSON file and reused until they are
+    older than the time to live, so most checks need no request at all. URLs
+    can be checked concurrently up front with probe, after which exists only
+    reads the cache. A URL whose check fails with a network error counts as
+    missing, like a failed download does, but the result is not cached. Can
+    be used from any thread.
+
+    Args:
+        session (Session): requests session to make the requests with
+        cache_path (str): Path of the JSON cache file
+        ttl (float): Seconds that cached results are reused for. Defaults to 7 days.
+        workers (int): Number of concurrent requests made by probe. Defaults to 8.
+        timeout (float): Request timeout in seconds. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        cache_path: str,
+        ttl: float = 7 * 24 * 3600,
+        workers: int = 8,
+        timeout: float = 30,
+    ):
+        self._session = session
+        self._cache_path = cache_path
+        self._ttl = ttl
+        self._workers = workers
+        self._timeout = timeout
+        if exists(cache_path):
+            self._cache = load_json(cache_path)
+        else:
+            self._cache = dict()
+        self._lock = threading.Lock()
+
+    def _cached(self, url: str):
+        entry = self._cache.get(url)
+        if entry is None or time() - entry["checked"] > self._ttl:
+            return None
+        return entry["exists"]
+
+    def _request(self, url: str):
+        try:
+            response = self._session.head(
+                url, allow_redirects=True, timeout=self._timeout
+            )
+            if response.status_code in (405, 501):
+                response = self._session.get(
+                    url,
+                    headers={"Range": "bytes=0-0"},
+                    allow_redirects=True,
+                    stream=True,
+                    timeout=self._timeout,
+                )
+                response.close()
+        except RequestException as ex:
+            logger.warning(f"Could not check {url}: {ex}")
+            return None
+        return response.status_code < 400
+
+    def _check(self, url: str) -> bool:
+        with self._lock:
+            url_exists = self._cached(url)
+        if url_exists is not None:
+            return url_exists
+        url_exists = self._request(url)
+        if url_exists is None:
+            return False
+        with self._lock:
+            self._cache[url] = {"exists": url_exists, "checked": time()}
+        return url_exists
+
+    def probe(self, urls: Iterable[str]) -> Dict[str, bool]:
+        """Check the URLs that are not cached concurrently and save the cache
+
+        Args:
+            urls (Iterable[str]): URLs to check
+
+        Returns:
+            Dict[str, bool]: Whether each URL exists
+        """
+        start = perf_counter()
+        urls = list(urls)
+        with self._lock:
+            uncached = [url for url in urls if self._cached(url) is None]
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="probe"
+        ) as executor:
+            results = dict(zip(uncached, executor.map(self._check, uncached)))
+        for url in urls:
+            if url not in results:
+                results[url] = self._check(url)
+        self.save()
+        logger.info(
+            f"Checked {len(uncached)} of {len(urls)} URLs in "
+            f"{perf_counter() - start:.1f}s, the rest were cached"
+        )
+        return results
+
+    def exists(self, url: str) -> bool:
+        """Whether a URL exists, using the cache if possible
+
+        Args:
+            url (str): URL to check
+
+        Returns:
+            bool: True if the URL exists
+        """
+        return self._check(url)
+
+    def save(self) -> None:
+        """Save the cache
+
+        Returns:
+            None
+        """
+        with self._lock:
+            save_json(self._cache, self._cache_path)
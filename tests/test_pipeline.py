@@ -3,21 +3,45 @@
 Unit tests for WHO.
 """
 
+import gc
+import logging
 from collections import OrderedDict
-from os.path import join
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os.path import getsize, join
+from threading import Thread
+from time import sleep
 from urllib.parse import urlparse
 
 import pytest
 from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
 from hdx.data.showcase import Showcase
 from hdx.database import Database
 from hdx.utilities.base_downloader import DownloadError
 from hdx.utilities.compare import assert_files_same
 from hdx.utilities.downloader import Download
-from hdx.utilities.path import temp_dir
+from hdx.utilities.loader import load_json
+from hdx.utilities.path import progress_storing_folder, temp_dir
 from hdx.utilities.retriever import Retrieve
+from hdx.utilities.saver import save_json
+from requests import Session
+from requests.exceptions import ChunkedEncodingError
+from sqlalchemy import inspect, select, text
+from tenacity import wait_fixed
 
+from hdx.scraper.who.__main__ import upload_dataset
+from hdx.scraper.who.async_ingest import AsyncIngest
+from hdx.scraper.who.country_workers import CountryWorkers
+from hdx.scraper.who.database.db_indicator_data import DBIndicatorData
+from hdx.scraper.who.database.db_indicator_state import DBIndicatorState
+from hdx.scraper.who.indicator_file import IndicatorFile, download_indicator_file
+from hdx.scraper.who.metrics import RunMetrics
 from hdx.scraper.who.pipeline import Pipeline
+from hdx.scraper.who.retry_queue import DeferredRetries
+from hdx.scraper.who.upload_queue import UploadQueue
+from hdx.scraper.who.upload_state import UploadState
+from hdx.scraper.who.url_probe import UrlProbe
 
 
 class MockRetrieve:
@@ -82,6 +106,18 @@ class MockRetrieve:
                         "INDICATOR_URL_NAME": "population-using-at-least-basic-sanitation-services-(-)",
                         "INDICATOR_CODE": "WSH_SANITATION_BASIC",
                     },
+                    # Duplicate category and indicator pair
+                    {
+                        "THEME_TITLE": "World Health Statistics",
+                        "INDICATOR_URL_NAME": "life-expectancy-at-birth-(years)",
+                        "INDICATOR_CODE": "WHOSIS_000001",
+                    },
+                    # Indicator that is not on the indicators page
+                    {
+                        "THEME_TITLE": "World Health Statistics",
+                        "INDICATOR_URL_NAME": "not-an-indicator",
+                        "INDICATOR_CODE": "NOT_AN_INDICATOR\t",
+                    },
                 ]
             }
         if key == "dimension" or key == "DIMENSION":
@@ -520,7 +556,47 @@ class TestPipeline:
     def retriever(self):
         return MockRetrieve()
 
-    def test_get_countriesdata(self, configuration, retriever, tmp_path):
+    @pytest.fixture
+    def saved_retriever(self, configuration, retriever, tmp_path):
+        """A real Retrieve using saved copies of the MockRetrieve data"""
+        saved_dir = tmp_path / "saved_data"
+        saved_dir.mkdir()
+        base_url = configuration["base_url"]
+        urls = [
+            f"{base_url}api/dimension",
+            f"{base_url}api/indicator",
+            f"{configuration['category_url']}GHO_MODEL/SF_HIERARCHY_INDICATORS",
+        ]
+        for dimension in ("SEX", "COUNTRY", "RESIDENCEAREATYPE"):
+            urls.append(f"{base_url}api/DIMENSION/{dimension}/DimensionValues")
+        for indicator_code in list(TestPipeline.indicators.keys()) + ["NO_DATA"]:
+            urls.append(f"{base_url}api/{indicator_code}")
+        with Download(user_agent="test") as downloader:
+            saved_retriever = Retrieve(
+                downloader,
+                str(tmp_path),
+                str(saved_dir),
+                str(tmp_path),
+                save=False,
+                use_saved=True,
+                prefix="who",
+            )
+            for url in urls:
+                try:
+                    data = retriever.download_json(url)
+                except DownloadError:
+                    continue
+                filename, _ = saved_retriever.get_filename(url, None, ("json",))
+                save_json(data, join(saved_dir, filename))
+            yield saved_retriever
+
+    @staticmethod
+    def get_indicator_data(session):
+        return session.execute(
+            select(DBIndicatorData).order_by(DBIndicatorData.id)
+        ).scalars()
+
+    def test_get_countriesdata(self, configuration, retriever, tmp_path, caplog):
         configuration = Configuration.read()
         with Database(
             dialect="sqlite", database=str(tmp_path / "test_who.sqlite")
@@ -530,6 +606,168 @@ class TestPipeline:
             who.populate_db(populate_db=True, create_archived_datasets=False)
             countriesdata = who.get_countries()
             assert countriesdata == [{"Code": "AFG"}]
+            assert (
+                "Category World Health Statistics with indicator WHOSIS_000001 "
+                "already exists, skipping" in caplog.messages
+            )
+            assert (
+                "Indicator code NOT_AN_INDICATOR was not found on the indicators page"
+                in caplog.messages
+            )
+            assert who.get_coverage() == {
+                "AFG": {
+                    "Global Health Estimates: Life expectancy and leading causes "
+                    "of death and disability",
+                    "World Health Statistics",
+                }
+            }
+            indexes = inspect(session.get_bind()).get_indexes("indicator_data")
+            assert [index["column_names"] for index in indexes] == [["country_code"]]
+            assert session.execute(text("SELECT count(*) FROM sqlite_stat1")).scalar()
+
+    def test_populate_db_download_workers(
+        self, configuration, retriever, saved_retriever, tmp_path
+    ):
+        results = []
+        for i, (
+            test_retriever,
+            download_workers,
+            async_ingest,
+            stream_json,
+        ) in enumerate(
+            (
+                (retriever, 1, False, False),
+                (saved_retriever, 3, False, False),
+                (saved_retriever, 2, True, False),
+                (saved_retriever, 1, False, True),
+                (saved_retriever, 2, True, True),
+            )
+        ):
+            with Database(
+                dialect="sqlite", database=str(tmp_path / f"test_who_{i}.sqlite")
+            ) as database:
+                session = database.get_session()
+                who = Pipeline(
+                    configuration,
+                    test_retriever,
+                    tmp_path,
+                    session,
+                    download_workers=download_workers,
+                    stream_json=stream_json,
+                )
+                who.populate_db(
+                    populate_db=True,
+                    create_archived_datasets=True,
+                    async_ingest=async_ingest,
+                )
+                results.append(
+                    [
+                        (row.id, row.indicator_code, row.country_code, row.numeric)
+                        for row in self.get_indicator_data(session)
+                    ]
+                )
+        assert len(results[0]) == 12
+        for result in results[1:]:
+            assert result == results[0]
+
+    def test_populate_db_incremental(self, configuration, saved_retriever, tmp_path):
+        database_path = str(tmp_path / "test_who.sqlite")
+        summaries = []
+        for run in range(4):
+            if run == 2:
+                path = join(saved_retriever.saved_dir, "who_api-tb-1.json")
+                indicator_json = load_json(path)
+                indicator_json["value"][0]["NumericValue"] = 50.0
+                save_json(indicator_json, path)
+            elif run == 3:
+                # TB_1 is no longer listed
+                path = join(saved_retriever.saved_dir, "who_api-indicator.json")
+                indicator_list = load_json(path)
+                indicator_list["value"] = [
+                    row
+                    for row in indicator_list["value"]
+                    if row["IndicatorCode"] != "TB_1"
+                ]
+                save_json(indicator_list, path)
+            with Database(dialect="sqlite", database=database_path) as database:
+                session = database.get_session()
+                who = Pipeline(
+                    configuration,
+                    saved_retriever,
+                    tmp_path,
+                    session,
+                    incremental=True,
+                )
+                who.populate_db(populate_db=True, create_archived_datasets=True)
+                summaries.append(who.get_refresh_summary())
+                rows = {row.id: row.numeric for row in self.get_indicator_data(session)}
+                if run == 2:
+                    assert len(rows) == 12
+                    assert rows[137943] == 50.0
+                states = {row.code for row in session.query(DBIndicatorState).all()}
+        assert summaries == [
+            {"refreshed": 4, "skipped": 0},
+            {"refreshed": 0, "skipped": 4},
+            {"refreshed": 1, "skipped": 3},
+            {"refreshed": 0, "skipped": 3},
+        ]
+        assert 137943 not in rows
+        assert "TB_1" not in states
+        assert len(states) == 3
+
+    def test_async_ingest_stats(self, tmp_path):
+        path = tmp_path / "api-tb-1.json"
+        save_json({"value": [{"Id": 1}, {"Id": 2}]}, str(path))
+        payloads = {
+            "dict": {"value": [{"Id": 3}]},
+            "file": IndicatorFile(str(path), False),
+        }
+        written = []
+
+        def write(item, payload, stats):
+            if isinstance(payload, IndicatorFile):
+                rows = list(payload.values(True))
+            else:
+                rows = payload["value"]
+            written.extend(row["Id"] for row in rows)
+            return len(rows)
+
+        stats = AsyncIngest(payloads.get, write, fetchers=2).run(["dict", "file"])
+        assert sorted(written) == [1, 2, 3]
+        assert stats["fetch"].rows == 1
+        assert stats["fetch"].bytes == getsize(path)
+        assert stats["insert"].rows == 3
+
+        def slow_fetch(item):
+            sleep(0.2)
+            return {"value": [{"Id": item}]}
+
+        stats = AsyncIngest(slow_fetch, write, fetchers=4).run(range(4))
+        assert stats["fetch"].rows == 4
+        assert 0.2 <= stats["fetch"].seconds < 0.6
+
+    def test_download_indicator_file_interrupted(self, tmp_path):
+        class Response:
+            status_code = 200
+            headers = {"ETag": '"new"'}
+
+            def iter_content(self, chunk_size):
+                yield b'{"value": ['
+                raise ChunkedEncodingError("Connection broken")
+
+        class Downloader:
+            def setup(self, url, headers):
+                return Response()
+
+        with Download(user_agent="test") as downloader:
+            retriever = Retrieve(
+                downloader, str(tmp_path), str(tmp_path), str(tmp_path)
+            )
+        retriever.downloader = Downloader()
+        state = {"etag": '"old"', "last_modified": None, "digest": "abc"}
+        with pytest.raises(DownloadError):
+            download_indicator_file(retriever, "https://test/api/TB_1", state)
+        assert not (tmp_path / "api-tb-1.json").exists()
 
     def test_generate_dataset_and_showcase(self, configuration, retriever, tmp_path):
         configuration = Configuration.read()
@@ -619,6 +857,256 @@ class TestPipeline:
                     join(tmp_path, filename),
                 )
 
+    def test_export_country_files(self, configuration, retriever, tmp_path, caplog):
+        with Database(
+            dialect="sqlite", database=str(tmp_path / "test_who.sqlite")
+        ) as database:
+            session = database.get_session()
+            who = Pipeline(configuration, retriever, tmp_path, session)
+            who.populate_db(populate_db=True, create_archived_datasets=True)
+            datasets = [
+                who.generate_dataset_and_showcase(TestPipeline.country)[0],
+                who.generate_archived_dataset(TestPipeline.country),
+            ]
+            exportdir = tmp_path / "export"
+            exportdir.mkdir()
+            who = Pipeline(configuration, retriever, exportdir, session)
+            who.populate_db(populate_db=False, create_archived_datasets=True)
+            with caplog.at_level(logging.INFO):
+                who.export_country_files(create_archived_datasets=True)
+            assert "Exported 12 rows to 4 files for AFG" in caplog.text
+            counters = who.get_metrics().get_report()["counters"]
+            assert counters["csv_bytes"] == [
+                {
+                    "labels": {},
+                    "value": sum(
+                        getsize(file.path)
+                        for file in who._exported_files["AFG"].values()
+                    ),
+                }
+            ]
+            exported_datasets = [
+                who.generate_dataset_and_showcase(TestPipeline.country)[0],
+                who.generate_archived_dataset(TestPipeline.country),
+            ]
+            for dataset, exported_dataset in zip(datasets, exported_datasets):
+                assert exported_dataset == dataset
+                resources = dataset.get_resources()
+                exported_resources = exported_dataset.get_resources()
+                assert exported_resources == resources
+                for resource, exported_resource in zip(resources, exported_resources):
+                    filename = exported_resource.get_file_to_upload()
+                    assert filename.startswith(str(exportdir))
+                    assert_files_same(resource.get_file_to_upload(), filename)
+
+    def test_country_workers(self, configuration, saved_retriever, tmp_path):
+        # The form of path that main passes
+        database_path = f"/{tmp_path}/test_who.sqlite"
+        with Database(dialect="sqlite", database=database_path) as database:
+            session = database.get_session()
+            who = Pipeline(configuration, saved_retriever, tmp_path, session)
+            who.populate_db(populate_db=True, create_archived_datasets=True)
+            session.commit()
+            expected = who.generate_dataset_and_showcase(TestPipeline.country)[0]
+
+            datasets = {}
+            sessions = set()
+
+            def process(worker_pipeline, country):
+                assert worker_pipeline is not who
+                sessions.add(worker_pipeline._session)
+                if country["Code"] == "CCC":
+                    raise ValueError("CCC failed")
+                if country["Code"] == "AFG":
+                    dataset = worker_pipeline.generate_dataset_and_showcase(country)[0]
+                    datasets[country["Code"]] = dataset
+                else:
+                    datasets[country["Code"]] = None
+
+            progressdir = tmp_path / "progress"
+            progressdir.mkdir()
+            info = {"folder": str(progressdir)}
+            countries = [TestPipeline.country] + [
+                {"Code": code} for code in ("BBB", "CCC", "DDD")
+            ]
+            workers = CountryWorkers(who, saved_retriever, database_path, 2)
+            with pytest.raises(ValueError):
+                workers.run(process, info, countries)
+            assert datasets["AFG"] == expected
+            assert "BBB" in datasets
+            assert "CCC" not in datasets
+            assert session not in sessions
+            assert 1 <= len(sessions) <= 2
+            assert info["progress"] == "Code=CCC"
+            with open(progressdir / "progress.txt") as f:
+                assert f.read() == "Code=CCC"
+
+    def test_upload_queue(self, tmp_path):
+        uploaded = []
+
+        def generate(country):
+            if country["Code"] == "BBB":
+                return None
+            return country["Code"]
+
+        def upload(code):
+            if code == "DDD":
+                raise HDXError("DDD failed")
+            uploaded.append(code)
+
+        info = {"folder": str(tmp_path)}
+        countries = [{"Code": code} for code in ("AAA", "BBB", "CCC", "EEE")]
+        stats = UploadQueue(generate, upload, 2, 1).run(info, countries)
+        assert sorted(uploaded) == ["AAA", "CCC", "EEE"]
+        assert stats["generate"].rows == 4
+        assert stats["upload"].rows == 3
+        assert info["progress"] == "Code=EEE"
+
+        uploaded.clear()
+        progressdir = tmp_path / "progress"
+        progressdir.mkdir()
+        info = {"folder": str(progressdir)}
+        countries.insert(3, {"Code": "DDD"})
+        with pytest.raises(HDXError):
+            UploadQueue(generate, upload, 2, 1).run(info, countries)
+        assert "DDD" not in uploaded
+        assert info["progress"] == "Code=DDD"
+        with open(progressdir / "progress.txt") as f:
+            assert f.read() == "Code=DDD"
+
+    def test_deferred_retries(self, tmp_path):
+        calls = []
+
+        def process(code, failures):
+            calls.append(code)
+            if calls.count(code) <= failures:
+                raise DownloadError(f"{code} failed")
+
+        retries = DeferredRetries(attempts=3, wait=wait_fixed(0))
+        retries.call("AAA", process, "AAA", 2)
+        retries.call("BBB", process, "BBB", 0)
+        retries.call("CCC", process, "CCC", 5)
+        assert calls == ["AAA", "BBB", "CCC"]
+        with pytest.raises(ValueError):
+            retries.call("DDD", int, "DDD")
+
+        summary_path = tmp_path / "retry_summary.json"
+        with pytest.raises(DownloadError, match="CCC failed"):
+            retries.drain(str(summary_path))
+        assert calls.count("AAA") == 3
+        assert calls.count("CCC") == 3
+        assert load_json(summary_path) == {
+            "recovered": [{"key": "AAA", "attempts": 3}],
+            "failed": [
+                {
+                    "key": "CCC",
+                    "attempts": 3,
+                    "error": "DownloadError: CCC failed",
+                }
+            ],
+        }
+
+        retries = DeferredRetries(wait=wait_fixed(10), time_budget=1)
+        retries.call("AAA", process, "AAA", 10)
+        with pytest.raises(DownloadError):
+            retries.drain()
+        assert retries.get_summary()["failed"][0]["attempts"] == 1
+
+        # A resumed run starts from the first country whose retries failed
+        progressdir = tmp_path / "progress"
+        progressdir.mkdir()
+        info = {"folder": str(progressdir)}
+        countries = [{"Code": code} for code in ("EEE", "FFF", "GGG", "HHH")]
+        calls.clear()
+        retries = DeferredRetries(attempts=2, wait=wait_fixed(0))
+        for _, country in progress_storing_folder(info, countries, "Code"):
+            code = country["Code"]
+            retries.call(code, process, code, 5 if code in ("FFF", "HHH") else 0)
+        with pytest.raises(DownloadError, match="FFF failed"):
+            retries.drain(None, info, countries)
+        with open(progressdir / "progress.txt") as f:
+            assert f.read() == "Code=FFF"
+        resumed = [
+            country["Code"]
+            for _, country in progress_storing_folder(info, countries, "Code")
+        ]
+        assert resumed == ["FFF", "GGG", "HHH"]
+
+    def test_upload_state(self, configuration, retriever, tmp_path):
+        with Database(
+            dialect="sqlite", database=str(tmp_path / "test_who.sqlite")
+        ) as database:
+            session = database.get_session()
+            hashes = []
+            for folder in ("run1", "run2"):
+                folder = tmp_path / folder
+                folder.mkdir()
+                who = Pipeline(configuration, retriever, folder, session)
+                who.populate_db(
+                    populate_db=folder.name == "run1", create_archived_datasets=False
+                )
+                who.export_country_files(create_archived_datasets=False)
+                dataset, showcase = who.generate_dataset_and_showcase(
+                    TestPipeline.country
+                )
+                hashes.append(UploadState.get_hash(dataset, showcase))
+            assert hashes[0] == hashes[1]
+            assert UploadState.get_hash(dataset) != hashes[1]
+
+            uploads = []
+            dataset.create_in_hdx = lambda **kwargs: uploads.append(dataset["name"])
+            showcase.create_in_hdx = lambda: None
+            showcase.add_dataset = lambda dataset: None
+            info = {"batch": "1234"}
+            path = str(tmp_path / "upload_hashes.json")
+            for _ in range(2):
+                upload_state = UploadState(path)
+                upload_dataset(
+                    TestPipeline.country, dataset, showcase, info, upload_state
+                )
+            assert uploads == ["who-data-for-afg"]
+            assert upload_state.skipped == 1
+
+            resource = dataset.get_resources()[0]
+            with open(resource.get_file_to_upload(), "a") as f:
+                f.write("changed")
+            upload_dataset(TestPipeline.country, dataset, showcase, info, upload_state)
+            assert uploads == ["who-data-for-afg", "who-data-for-afg"]
+
+    def test_parquet_store(self, configuration, retriever, tmp_path):
+        pytest.importorskip("pyarrow")
+        exported = []
+        for data_store in ("sqlite", "parquet"):
+            folder = tmp_path / data_store
+            folder.mkdir()
+            with Database(
+                dialect="sqlite", database=str(folder / "test_who.sqlite")
+            ) as database:
+                session = database.get_session()
+                who = Pipeline(
+                    configuration, retriever, folder, session, data_store=data_store
+                )
+                who.populate_db(populate_db=True, create_archived_datasets=True)
+                assert who.get_coverage() == {
+                    "AFG": {
+                        "Global Health Estimates: Life expectancy and leading causes "
+                        "of death and disability",
+                        "World Health Statistics",
+                    }
+                }
+                who.export_country_files(create_archived_datasets=True)
+                exported.append(who._exported_files)
+                rows = session.execute(select(DBIndicatorData.id)).all()
+                assert len(rows) == (12 if data_store == "sqlite" else 0)
+        assert exported[1].keys() == exported[0].keys()
+        for filename, file in exported[0]["AFG"].items():
+            parquet_file = exported[1]["AFG"][filename]
+            assert (parquet_file.start_year, parquet_file.end_year) == (
+                file.start_year,
+                file.end_year,
+            )
+            assert_files_same(file.path, parquet_file.path)
+
     def test_showcase(self, configuration):
         with temp_dir(
             "TestWho",
@@ -687,6 +1175,136 @@ class TestPipeline:
                 )
                 assert showcase == Showcase({"name": "who-data-for-afg-showcase"})
 
+    def test_url_probe(self, tmp_path):
+        requests_made = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                requests_made.append((self.command, self.path))
+                if self.path == "/nohead" and self.command == "HEAD":
+                    self.send_response(405)
+                elif self.path in ("/exists", "/nohead"):
+                    self.send_response(200)
+                else:
+                    self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            do_HEAD = respond
+            do_GET = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        urls = [f"{base_url}/exists", f"{base_url}/nohead", f"{base_url}/missing"]
+        cache_path = str(tmp_path / "showcase_urls.json")
+        try:
+            with Session() as session:
+                probe = UrlProbe(session, cache_path, workers=2)
+                assert probe.probe(urls) == {
+                    urls[0]: True,
+                    urls[1]: True,
+                    urls[2]: False,
+                }
+                assert sorted(requests_made) == [
+                    ("GET", "/nohead"),
+                    ("HEAD", "/exists"),
+                    ("HEAD", "/missing"),
+                    ("HEAD", "/nohead"),
+                ]
+                requests_made.clear()
+                probe = UrlProbe(session, cache_path)
+                probe.probe(urls)
+                assert probe.exists(urls[0]) is True
+                assert requests_made == []
+                probe = UrlProbe(session, cache_path, ttl=0)
+                assert probe.exists(urls[2]) is False
+                assert requests_made == [("HEAD", "/missing")]
+        finally:
+            server.shutdown()
+
+        showcase = Pipeline.get_showcase(
+            None,
+            "AFG",
+            "Afghanistan",
+            "who-data-for-afg",
+            ["hxl"],
+            url_exists=lambda url: False,
+        )
+        assert showcase == {"name": "who-data-for-afg-showcase"}
+
+    def test_run_metrics(self, tmp_path):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "5")
+                self.end_headers()
+                self.wfile.write(b"hello")
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        metrics = RunMetrics()
+        try:
+            with Session() as session:
+                metrics.instrument_session(session)
+                for _ in range(2):
+                    with session.get(
+                        f"http://127.0.0.1:{server.server_port}/", stream=True
+                    ) as response:
+                        assert response.content == b"hello"
+        finally:
+            server.shutdown()
+        # Responses that have been collected are counted and forgotten
+        del response
+        gc.collect()
+        assert metrics._pending_responses == {}
+        metrics.add("db_rows_written", 10, table="indicator_data")
+        metrics.add("db_rows_written", 5, table="indicator_data")
+        metrics.observe("stage", 2.0, stage="export")
+        metrics.observe("stage", 1.0, stage="export")
+        json_path = str(tmp_path / "run_metrics.json")
+        textfile_path = str(tmp_path / "who.prom")
+        with pytest.raises(ValueError):
+            with metrics.report(json_path, textfile_path):
+                raise ValueError("failed")
+
+        report = load_json(json_path)
+        assert report["counters"] == {
+            "db_rows_written": [{"labels": {"table": "indicator_data"}, "value": 15}],
+            "http_requests": [{"labels": {"host": "127.0.0.1"}, "value": 2}],
+            "http_response_bytes": [{"labels": {"host": "127.0.0.1"}, "value": 10}],
+        }
+        assert report["durations"] == {
+            "stage": [
+                {
+                    "labels": {"stage": "export"},
+                    "count": 2,
+                    "seconds": 3.0,
+                    "max_seconds": 2.0,
+                }
+            ]
+        }
+        assert report["gauges"]["run_success"] == [{"labels": {}, "value": 0}]
+        with open(textfile_path) as file:
+            lines = file.read().splitlines()
+        assert "# TYPE who_db_rows_written_total counter" in lines
+        assert 'who_db_rows_written_total{table="indicator_data"} 15' in lines
+        assert 'who_http_requests_total{host="127.0.0.1"} 2' in lines
+        assert "# TYPE who_stage_seconds summary" in lines
+        assert 'who_stage_seconds_count{stage="export"} 2' in lines
+        assert 'who_stage_seconds_sum{stage="export"} 3.000000' in lines
+        assert 'who_stage_max_seconds{stage="export"} 2.000000' in lines
+        assert "who_run_success 0" in lines
+        assert lines[-1] == "# EOF"
+
     def test_generate_archived_dataset(self, configuration, retriever, tmp_path):
         configuration = Configuration.read()
         with Database(
@@ -727,3 +1345,12 @@ class TestPipeline:
             assert_files_same(
                 join("tests", "fixtures", filename), join(tmp_path, filename)
             )
+
+            expected = Dataset(dict(dataset.data))
+            expected.update_from_yaml(
+                join(
+                    "src", "hdx", "scraper", "who", "config", "hdx_dataset_static.yaml"
+                )
+            )
+            who.update_from_static_metadata(dataset)
+            assert dataset == expected